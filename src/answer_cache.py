@@ -0,0 +1,139 @@
+# --- SEMANTIC ANSWER CACHE ---
+# Persistent cache of Gemini answers keyed by chassis code + question embedding.
+# A new question hits when an earlier one for the same chassis is within the
+# cosine similarity threshold, so paraphrases share answers across users.
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from metrics import cache_result
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SemanticAnswerCache:
+    """SQLite-backed answer store with similarity lookup, TTL and LRU eviction."""
+
+    def __init__(self, db_path, threshold=0.92, ttl_seconds=7 * 24 * 3600, max_entries=5000):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # chassis -> (row ids, stacked unit vectors); rebuilt lazily after writes
+        self._index = {}
+        self._latest_id = None  # max(id) the matrices were built at
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chassis TEXT NOT NULL,
+                question TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                answer TEXT NOT NULL,
+                sources TEXT NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_chassis ON answers(chassis)")
+        self._purge_expired()
+        self._conn.commit()
+
+    def lookup(self, chassis, embedding):
+        """Return (answer, sources, similarity) for the closest cached question, or None."""
+        query = normalize(embedding)
+        with self._lock:
+            self._sync_index()
+            ids, matrix = self._chassis_index(chassis)
+            if not ids:
+                self.misses += 1
+                cache_result("answer", hit=False)
+                return None
+
+            scores = matrix @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                cache_result("answer", hit=False)
+                return None
+
+            row = self._conn.execute(
+                "SELECT answer, sources, created FROM answers WHERE id = ?", (ids[best],)
+            ).fetchone()
+            if row is None or time.time() - row[2] > self.ttl_seconds:
+                self.misses += 1
+                cache_result("answer", hit=False)
+                return None
+
+            self._conn.execute("UPDATE answers SET last_access = ? WHERE id = ?", (time.time(), ids[best]))
+            self._conn.commit()
+            self.hits += 1
+            cache_result("answer", hit=True)
+            return row[0], json.loads(row[1]), float(scores[best])
+
+    def store(self, chassis, question, embedding, answer, sources=()):
+        """Cache an answer; `sources` is a list of {"page_content", "metadata"} dicts."""
+        vector = normalize(embedding)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO answers (chassis, question, embedding, answer, sources, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chassis, question, vector.tobytes(), answer, json.dumps(list(sources)), now, now)
+            )
+            self._evict()
+            self._conn.commit()
+            self._index.clear()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._conn.commit()
+            self._index.clear()
+
+    # --- INTERNALS ---
+    def _sync_index(self):
+        # Other workers insert into the same file; ids only grow (AUTOINCREMENT), so a
+        # new max(id) means some process stored an answer. Deleted rows just miss.
+        latest = self._conn.execute("SELECT max(id) FROM answers").fetchone()[0]
+        if latest != self._latest_id:
+            self._index.clear()
+            self._latest_id = latest
+
+    def _chassis_index(self, chassis):
+        if chassis not in self._index:
+            cutoff = time.time() - self.ttl_seconds
+            rows = self._conn.execute(
+                "SELECT id, embedding FROM answers WHERE chassis = ? AND created >= ?", (chassis, cutoff)
+            ).fetchall()
+            ids = [r[0] for r in rows]
+            matrix = np.stack([np.frombuffer(r[1], dtype=np.float32) for r in rows]) if rows else None
+            self._index[chassis] = (ids, matrix)
+        return self._index[chassis]
+
+    def _purge_expired(self):
+        self._conn.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl_seconds,))
+
+    def _evict(self):
+        self._purge_expired()
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_access ASC LIMIT ?)",
+                (excess,)
+            )
@@ -0,0 +1,338 @@
+# --- BENCHMARK SUITE ---
+# Reproducible latency numbers for the three hot paths:
+#   vision     B4 throughput / latency per batch size and torch thread count
+#   retrieval  question embedding + search latency per retrieval strategy
+#   e2e        decode -> classify -> retrieve -> context -> answer, with a
+#              local stub instead of Gemini (no network, fixed latency)
+# Reports p50/p95/p99 and peak RSS, and writes everything to JSON so runs
+# from different commits can be compared:
+#
+#   cd src
+#   python -m benchmark --out ../bench/before.json
+#   python -m benchmark --out ../bench/after.json --compare ../bench/before.json
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import pipeline
+from pipeline import decode_image, extract_chassis_code, generate_answer
+
+SUITES = ("vision", "retrieval", "e2e")
+
+# (chassis, question) pairs used when no --questions file is given
+DEFAULT_QUESTIONS = [
+    ("E30", "How do I adjust the valve clearance on the M20 engine?"),
+    ("E36", "What is the torque spec for the lug nuts?"),
+    ("E39", "Why does the cooling fan run constantly?"),
+    ("E46", "How do I replace the front control arm bushings?"),
+    ("E46", "What oil does the M54B30 take and how much?"),
+    ("E34", "How do I bleed the brakes?"),
+    ("E53", "What causes a transfer case fault on the X5?"),
+    ("Z3", "How do I replace the convertible top rear window?"),
+    (None, "What is the firing order of a BMW inline six?"),
+]
+
+
+# --- MEASUREMENT HELPERS ---
+def summarize(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        "n": int(samples.size),
+        "mean_ms": float(samples.mean()),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "max_ms": float(samples.max()),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_questions(path):
+    if not path:
+        return DEFAULT_QUESTIONS
+    questions = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                questions.append((row.get("chassis"), row["question"]))
+    return questions
+
+
+def synthetic_jpegs(count, size=(1024, 768), seed=0):
+    """Random-noise JPEGs at phone-upload size, so decode cost is realistic."""
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+        buf = io.BytesIO()
+        Image.fromarray(pixels).save(buf, format="JPEG", quality=90)
+        images.append(buf.getvalue())
+    return images
+
+
+def load_image_bytes(folder, limit):
+    from vision_backends import IMAGE_EXTENSIONS
+
+    images = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(folder, name), 'rb') as f:
+                images.append(f.read())
+        if len(images) >= limit:
+            break
+    if not images:
+        raise FileNotFoundError(f"No images found in {folder}")
+    return images
+
+
+# --- STUB LLM ---
+class StubGeminiClient:
+    """Stands in for GeminiClient: canned answer after a fixed delay, no network."""
+
+    def __init__(self, latency_ms=800.0, chunks=20):
+        self.latency = latency_ms / 1000.0
+        self.chunks = chunks
+
+    def invoke(self, car_model, question, context_text, api_key):
+        time.sleep(self.latency)
+        return f"Stub answer for {car_model} ({len(context_text)} context chars)."
+
+    def stream(self, car_model, question, context_text, api_key, on_complete=None):
+        pieces = []
+        for i in range(self.chunks):
+            time.sleep(self.latency / self.chunks)
+            pieces.append(f"chunk{i} ")
+            yield pieces[-1]
+        if on_complete is not None:
+            on_complete("".join(pieces))
+
+
+# --- SUITES ---
+def load_vision(args):
+    from vision_backends import build_backend, load_backend_classifier
+
+    if not args.random_weights:
+        return load_backend_classifier(args.backend, args.model, args.classes)
+    # Same architecture and cost as the real model, for machines without the .pth
+    from vision import ClassGroups, build_model, load_class_map
+
+    classes, idx_to_class = load_class_map(args.classes)
+    model = build_model(len(classes)).eval()
+    return build_backend(args.backend, model), classes, idx_to_class, ClassGroups(idx_to_class)
+
+
+def bench_vision(args, image_bytes):
+    import torch
+    from vision import classify_tensors, preprocess
+
+    model, classes, _, groups = load_vision(args)
+    tensors = torch.stack([preprocess(decode_image(b)) for b in image_bytes])
+
+    rows = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for batch_size in args.batch_sizes:
+            batch = tensors.repeat((batch_size + len(tensors) - 1) // len(tensors), 1, 1, 1)[:batch_size]
+            for _ in range(args.warmup):
+                classify_tensors(batch, model, classes, groups)
+            samples = [timed(classify_tensors, batch, model, classes, groups)[1] for _ in range(args.iterations)]
+            row = {"threads": threads, "batch_size": batch_size, **summarize(samples)}
+            row["images_per_sec"] = batch_size * 1000 / row["mean_ms"]
+            rows.append(row)
+            print(f"  vision  threads={threads:<3} batch={batch_size:<3} p50={row['p50_ms']:8.1f}ms "
+                  f"p95={row['p95_ms']:8.1f}ms  {row['images_per_sec']:6.1f} img/s")
+    return {"backend": args.backend, "random_weights": args.random_weights, "runs": rows}
+
+
+def bench_retrieval(args, questions, retriever):
+    embed_ms, embed_uncached_ms, strategy_ms, retrieve_ms = [], [], {}, []
+    for _ in range(args.iterations):
+        for chassis, question in questions:
+            embedding, ms = timed(retriever.embed, question)
+            embed_ms.append(ms)
+            if hasattr(retriever.db.embeddings, "embed_uncached"):
+                # retriever.embed hits the query cache after the first iteration
+                embed_uncached_ms.append(timed(retriever.db.embeddings.embed_uncached, question)[1])
+            # Every strategy the plan would fall back to, each timed on its own
+            for strategy, search_filter in retriever.plan(chassis):
+                _, ms = timed(retriever.search, embedding, search_filter, question)
+                strategy_ms.setdefault(strategy, []).append(ms)
+            _, ms = timed(retriever.retrieve, embedding, chassis, question=question)
+            retrieve_ms.append(ms)
+
+    report = {
+        "k": retriever.k,
+        "hybrid": retriever.hybrid is not None,
+        "sharded": retriever.shards is not None,
+        "embed": summarize(embed_ms),
+        "retrieve": summarize(retrieve_ms),
+        "strategies": {name: summarize(samples) for name, samples in strategy_ms.items()},
+    }
+    if embed_uncached_ms:
+        report["embed_uncached"] = summarize(embed_uncached_ms)
+    print(f"  retrieval  embed p50={report['embed']['p50_ms']:.1f}ms  retrieve p50={report['retrieve']['p50_ms']:.1f}ms")
+    for name, stats in report["strategies"].items():
+        print(f"    {name:<22} p50={stats['p50_ms']:7.1f}ms p95={stats['p95_ms']:7.1f}ms")
+    return report
+
+
+def bench_e2e(args, questions, image_bytes, engine, retriever):
+    pipeline._llm_client = StubGeminiClient(latency_ms=args.stub_latency_ms)
+
+    classify_ms, answer_ms, total_ms = [], [], []
+    for i in range(args.iterations):
+        for j, (chassis, question) in enumerate(questions):
+            start = time.perf_counter()
+            result = engine.classify(decode_image(image_bytes[(i + j) % len(image_bytes)]))
+            classified = time.perf_counter()
+            # Synthetic images classify as anything; the question's chassis keeps retrieval realistic
+            car_model = result["display_name"]
+            generate_answer(car_model, question, retriever, "benchmark",
+                            chassis_override=chassis or extract_chassis_code(car_model))
+            done = time.perf_counter()
+            classify_ms.append((classified - start) * 1000)
+            answer_ms.append((done - classified) * 1000)
+            total_ms.append((done - start) * 1000)
+
+    report = {
+        "stub_latency_ms": args.stub_latency_ms,
+        "classify": summarize(classify_ms),
+        "answer": summarize(answer_ms),
+        "total": summarize(total_ms),
+    }
+    print(f"  e2e  total p50={report['total']['p50_ms']:.1f}ms p95={report['total']['p95_ms']:.1f}ms "
+          f"p99={report['total']['p99_ms']:.1f}ms (stub Gemini {args.stub_latency_ms:.0f}ms)")
+    return report
+
+
+# --- COMPARISON ---
+def _flatten(node, prefix=""):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield from _flatten(value, f"{prefix}.{key}" if prefix else key)
+    elif isinstance(node, list):
+        for item in node:
+            label = f"threads={item.get('threads')},batch={item.get('batch_size')}" if isinstance(item, dict) else ""
+            yield from _flatten(item, f"{prefix}[{label}]")
+    elif isinstance(node, (int, float)) and not isinstance(node, bool):
+        yield prefix, node
+
+
+def compare(baseline, current):
+    old = dict(_flatten(baseline))
+    print(f"\n{'metric':<70}{'before':>10}{'after':>10}{'change':>9}")
+    for key, value in _flatten(current):
+        if not (key.endswith(("p50_ms", "p95_ms", "p99_ms", "images_per_sec")) or "peak_rss" in key):
+            continue
+        if key in old and old[key]:
+            print(f"{key:<70}{old[key]:>10.1f}{value:>10.1f}{(value - old[key]) / old[key]:>+9.1%}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vision, retrieval and end-to-end latency.")
+    parser.add_argument("--suites", default=",".join(SUITES))
+    parser.add_argument("--out", default="benchmark.json", help="Where to write the JSON results")
+    parser.add_argument("--compare", help="Earlier results JSON to diff against")
+    parser.add_argument("--images", help="Image folder (default: synthetic 1024x768 JPEGs)")
+    parser.add_argument("--questions", help='JSONL of {"chassis", "question"} (default: built-in set)')
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16")
+    parser.add_argument("--threads", default=None, help="torch thread counts, e.g. 1,2,4 (default: current)")
+    parser.add_argument("--backend", default="fp32")
+    parser.add_argument("--model", default=pipeline.MODEL_PATH)
+    parser.add_argument("--classes", default=pipeline.CLASS_JSON_PATH)
+    parser.add_argument("--random-weights", action="store_true",
+                        help="Benchmark the B4 architecture without the trained weights")
+    parser.add_argument("--stub-latency-ms", type=float, default=800.0)
+    args = parser.parse_args()
+
+    import torch
+
+    suites = [s for s in args.suites.split(",") if s]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    args.batch_sizes = [int(b) for b in args.batch_sizes.split(",")]
+    args.threads = [int(t) for t in args.threads.split(",")] if args.threads else [torch.get_num_threads()]
+
+    image_bytes = load_image_bytes(args.images, 32) if args.images else synthetic_jpegs(8)
+    questions = load_questions(args.questions)
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare", "out")},
+        },
+        "peak_rss_mb": {},
+    }
+
+    if "vision" in suites:
+        results["vision"] = bench_vision(args, image_bytes)
+        results["peak_rss_mb"]["after_vision"] = peak_rss_mb()
+
+    if "retrieval" in suites or "e2e" in suites:
+        _, retriever = pipeline.build_rag_stack()
+        if "retrieval" in suites:
+            results["retrieval"] = bench_retrieval(args, questions, retriever)
+            results["peak_rss_mb"]["after_retrieval"] = peak_rss_mb()
+        if "e2e" in suites:
+            from inference_engine import VisionInferenceEngine
+
+            torch.set_num_threads(args.threads[0])
+            model, classes, _, groups = load_vision(args)
+            with VisionInferenceEngine(model, classes, groups) as engine:
+                results["e2e"] = bench_e2e(args, questions, image_bytes, engine, retriever)
+            results["peak_rss_mb"]["after_e2e"] = peak_rss_mb()
+
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(out_dir, exist_ok=True)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\n✅ Peak RSS {max(results['peak_rss_mb'].values(), default=peak_rss_mb()):.0f} MB -> {args.out}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,34 @@
 # AI Generated Content Disclaimer
 #The code within this file was originally generated by Google Gemini.
 import streamlit as st
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torchvision import models, transforms
-from PIL import Image
-import json
+from PIL import UnidentifiedImageError
 import os
-import time
 import hashlib
+import requests
 
-# --- LANGCHAIN & GEMINI IMPORTS ---
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_google_genai import ChatGoogleGenerativeAI
-from google import genai
-from google.genai.errors import APIError
-from langchain_core.prompts import ChatPromptTemplate
-from google.api_core.exceptions import ResourceExhausted
+# --- LOCAL MODULES ---
+# Models, retrieval and Gemini live in pipeline.py; this file is only the UI
+from pipeline import DB_PATH, STARTUP_LABELS, Pipeline, decode_image
+from image_io import ImageTooLarge, make_preview
+from service_client import describe_service_error
+from warmup import FAILED, READY
 
 
 
 current_folder = os.path.dirname(os.path.abspath(__file__))
-parent_folder = os.path.dirname(current_folder)
 
 # --- CONFIGURATION ---
-MODEL_PATH = f"{parent_folder}/models/bmw_model_b4_noncar.pth"
-CLASS_JSON_PATH = f"{parent_folder}/models/bmw_class_map_b4.json"
-DB_PATH = f"{parent_folder}/models/bmw_knowledge_db_rag_paddleocr"
-EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Set to a running service.py (e.g. http://localhost:8000) to use it instead of
+# loading the models in this process
+API_URL = os.environ.get("BMW_API_URL")
+# Serve Prometheus metrics (metrics.py) on this port, e.g. 9100
+METRICS_PORT = int(os.environ.get("BMW_METRICS_PORT", 0))
 
 # --- DEBUG CHECK ---
 print(f"📂 Script Location: {current_folder}")
-print(f"📂 Target DB Path: {DB_PATH}")
+print(f"📂 Target DB Path: {DB_PATH}" if not API_URL else f"🌐 Pipeline Service: {API_URL}")
 
-if not os.path.exists(DB_PATH):
+if not API_URL and not os.path.exists(DB_PATH):
     st.error(f"❌ CRITICAL ERROR: Database folder not found at: {DB_PATH}")
     st.info("Please check: Is the folder name exactly 'bmw_knowledge_db_rag_paddleocr'? Is it inside the 'models' folder?")
     st.stop()
@@ -117,207 +110,42 @@ with title_col:
 
 st.markdown("Upload a photo of a BMW. I will identify it and answer technical questions.")
 
-# --- STEP 1: LOAD THE VISION MODEL ---
+# --- STEP 1: LOAD THE PIPELINE ---
+# One per process, shared by every session; models load in background threads
 @st.cache_resource
-def load_vision_model():
-    with open(CLASS_JSON_PATH, 'r') as f:
-        class_map = json.load(f)
-        # Fix: Create an integer-keyed map for logic
-        idx_to_class = {int(k): v for k, v in class_map.items()}
-        classes = [idx_to_class[i] for i in range(len(idx_to_class))]
-    
-    model = models.efficientnet_b4(weights=None)
-    num_features = model.classifier[1].in_features 
-    model.classifier[1] = nn.Linear(num_features, len(classes))
-    
-    try:
-        model.load_state_dict(torch.load(MODEL_PATH, map_location=torch.device('cpu')))
-    except RuntimeError as e:
+def load_pipeline():
+    if METRICS_PORT:
+        from metrics import start_http_server
+        start_http_server(METRICS_PORT)
+    if API_URL:
+        from service_client import RemotePipeline
+        return RemotePipeline(API_URL)
+    return Pipeline()
+
+# Errors from a pipeline call, shown in the page instead of a traceback
+def show_pipeline_error(e):
+    if isinstance(e, requests.RequestException):
+        # Only with BMW_API_URL: RemotePipeline talks to service.py
+        if isinstance(e, requests.HTTPError):
+            st.error(f"❌ Pipeline service error: {describe_service_error(e)}")
+        else:
+            st.error(f"❌ Pipeline service unreachable at {API_URL}: {e}")
+    elif isinstance(e, RuntimeError) and "state_dict" in str(e):
+        # load_state_dict refusing the checkpoint, re-raised from the model load
         st.error(f"Architecture Mismatch: {e}")
-        st.stop()
-        
-    model.eval()
-    return model, classes, idx_to_class
-
-# --- STEP 2: LOAD THE RAG BRAIN ---
-@st.cache_resource
-def load_rag_system():
-    embedding_func = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
-    db = Chroma(persist_directory=DB_PATH, embedding_function=embedding_func)
-    return db
-
-# --- STEP 3: PIPELINE FUNCTIONS (ROBUST LOGIC) ---
-def robust_process_image(image, model, classes, idx_to_class):
-    # 1. Vision Transforms (EfficientNet B4 Native)
-    transform = transforms.Compose([
-        transforms.Resize(380),
-        transforms.CenterCrop(380),
-        transforms.ToTensor(),
-        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-    ])
-    
-    img_t = transform(image).unsqueeze(0)
-    
-    with torch.no_grad():
-        outputs = model(img_t)
-        probs = F.softmax(outputs, dim=1)[0]
-    
-    # 2. Logic: Sum Probabilities (The Ferrari & 26% Fix)
-    bmw_indices = [idx for idx, name in idx_to_class.items() if "non" not in name.lower()]
-    non_bmw_indices = [idx for idx, name in idx_to_class.items() if "non" in name.lower()]
-            
-    bmw_total_score = sum(probs[i].item() for i in bmw_indices)
-    non_bmw_total_score = sum(probs[i].item() for i in non_bmw_indices)
-    
-    # 3. Find Specific Model Leaders
-    top_probs, top_indices = torch.topk(probs, 3)
-    chart_data = []
-    for i in range(3):
-        idx = top_indices[i].item()
-        score = top_probs[i].item() * 100
-        name = classes[idx]
-        chart_data.append((name, score))
-
-    best_bmw_idx = max(bmw_indices, key=lambda i: probs[i].item())
-    best_bmw_prob = probs[best_bmw_idx].item()
-            
-    best_non_idx = max(non_bmw_indices, key=lambda i: probs[i].item()) if non_bmw_indices else None
-
-    # 4. Return Structured Decision
-    if non_bmw_total_score > bmw_total_score:
-        return {
-            "is_valid": False,
-            "display_name": classes[best_non_idx] if best_non_idx is not None else "Unknown Non-BMW",
-            "raw_score": best_bmw_prob * 100,
-            "category_score": non_bmw_total_score * 100,
-            "chart_data": chart_data
-        }
+    elif isinstance(e, ValueError):
+        st.error(f"Vision Backend Error: {e}")
     else:
-        return {
-            "is_valid": True,
-            "display_name": classes[best_bmw_idx],
-            "raw_score": best_bmw_prob * 100,
-            "category_score": bmw_total_score * 100,
-            "chart_data": chart_data
-        }
-
-def format_class_name(raw_name):
-    if raw_name == "non_bmw_cars":
-        return "Non-BMW Car"
-    if raw_name == "non_cars":
-        return "Not a Vehicle"
-    return raw_name.replace("_", " ")
-
-# --- CACHED GEMINI FUNCTION ---
-@st.cache_data(show_spinner=False, ttl=3600) 
-def ask_gemini_with_cache(car_model, user_question, context_text, api_key):
-    # Setup
-    llm = ChatGoogleGenerativeAI(
-        model="gemini-2.5-flash-lite",
-        temperature=0,
-        google_api_key=api_key,
-        convert_system_message_to_human=True,
-        max_retries=1
-    )
-    
-    prompt = ChatPromptTemplate.from_template("""
-    You are a professional and objective BMW mechanic information assistant. Your tone must be human-like, direct, technical, and strictly focused on providing procedural or technical information.
-
-    Context from Expert Guides/Forums:
-    {context}
-
-    The user has identified their car as a: {car_model}
-    User Question: {question}
-
-    Instructions:
-    1.  **Primary Rule:** Answer the user's question based strictly on the technical and procedural information found within the provided context.
-    2.  **Anecdotal/Narrative Filtering:** **Crucially, ignore and omit all personal, anecdotal, or non-technical details (e.g., mentions of specific people, purchase stories, personal opinions, car histories, or project timelines) from the context.** Focus only on facts, steps, parts, and technical specifications.
-    3.  **Handling Mentioned Procedures:** If the context mentions a specific procedure or modification (like a "Euro bumper swap") but **does not** provide the detailed technical steps, summarize the finding by stating that information *about the existence and availability of this modification* is present in enthusiast discussions, but the step-by-step instructions are not detailed in the provided materials. **Do not mention any specific person by name.**
-    4.  **General Knowledge Fallback:** If the answer requires information not available in the context (after filtering), you must clearly state: "The detailed technical steps are not available in the provided materials."
-    5.  **Model Fallback:** If the user's car model is NOT in the context, strictly state: "I couldn't find detailed information for this specific model in my database, but here is general information based on standard automotive knowledge:" and then provide a helpful answer based on general knowledge.
-    """)
-
-    chain = prompt | llm
-    
-    # Retry Logic with Backoff
-    max_retries = 3
-    
-    for attempt in range(max_retries):
-        try:
-            response = chain.invoke({
-                "context": context_text, 
-                "car_model": car_model, 
-                "question": user_question
-            })
-            return response.content
-        except ResourceExhausted:
-            wait_time = (attempt + 1) * 5 
-            time.sleep(wait_time)
-            continue
-        except Exception as e:
-            return f"⚠️ **AI Error:** {str(e)}"
-    
-    return "⚠️ **Traffic Limit Reached:** The AI is currently overwhelmed (Quota Limit). Please wait 60 seconds and try again."
-
-def extract_chassis_code(raw_name):
-    # Helper to ensure we get "E36" from "BMW E36" or "E36 Convertible"
-    known_codes = [
-        "E24", "E28", "E30", "E31", "E32", "E34",
-        "E36", "E38", "E39", "E46", "E52", "E53", "E83",
-        "Z1", "Z3", "Z8", "X5"
-    ]
-    raw_name = raw_name.upper()
-    for code in known_codes:
-        if code in raw_name:
-            return code
-    return None
-
-def generate_answer(car_model, user_question, db, api_key, chassis_override=None):
-    # 1. Determine which chassis code to use
-    if chassis_override:
-        chassis_code = chassis_override
-    else:
-        chassis_code = extract_chassis_code(car_model)
-    
-    docs = []
-    used_strategy = "Specific"
+        st.error(f"❌ {type(e).__name__}: {e}")
 
+# Vision load errors surface on first use
+def run_vision(call, *args):
     try:
-        if chassis_code and chassis_code != "General":
-            # STRATEGY A: Hard Filter (Strict Mode)
-            docs = db.similarity_search(
-                user_question, 
-                k=8, 
-                filter={"car_model": chassis_code}
-            )
-        
-        # STRATEGY B: Fallback to General/No-Filter if Specific fails
-        if not docs:
-            used_strategy = "General Fallback"
-            docs = db.similarity_search(
-                user_question,
-                k=8,
-                filter={"car_model": "General"}
-            )
-            
-            # If still nothing, do a global search
-            if not docs:
-                 used_strategy = "Global (Last Resort)"
-                 docs = db.similarity_search(f"{car_model} {user_question}", k=8)
-
+        return call(*args)
     except Exception as e:
-        return f"⚠️ **Database Error:** {str(e)}", []
-    
-    # Context Construction
-    if not docs:
-        return "⚠️ I couldn't find any relevant manual pages for this specific issue.", []
+        show_pipeline_error(e)
+        st.stop()
 
-    context_text = "\n\n".join([f"[Source: {d.metadata.get('car_model', 'Unknown')}] {d.page_content}" for d in docs])
-    full_prompt_question = f"User Question: {user_question}\n(Search Strategy Used: {used_strategy})"
-    
-    answer_content = ask_gemini_with_cache(car_model, full_prompt_question, context_text, api_key)
-    
-    return answer_content, docs
 # ... (rest of imports and definitions) ...
 
 # --- API KEY VALIDATION (NO CACHE) ---
@@ -325,6 +153,9 @@ def validate_gemini_api_key(api_key: str) -> bool:
     if not api_key:
         return False
 
+    from google import genai
+    from google.genai.errors import APIError
+
     try:
         # Initialize the client by passing the key. 
         client = genai.Client(api_key=api_key)
@@ -340,7 +171,6 @@ def validate_gemini_api_key(api_key: str) -> bool:
 # Function to run when key is entered/changed
 def check_and_store_key():
     user_api_key = st.session_state['user_api_key_input']
-    was_valid_before = st.session_state['is_key_valid']
 
     st.session_state['key_attempted'] = True
     
@@ -349,9 +179,6 @@ def check_and_store_key():
 
     if is_valid_now:
         st.session_state['gemini_api_key'] = user_api_key
-        # FIX: Clear cache if the key status just changed from invalid/blank to valid
-        if not was_valid_before:
-             st.cache_data.clear()
     else:
         st.session_state['gemini_api_key'] = ''
 
@@ -410,36 +237,59 @@ with st.sidebar:
     st.markdown("""Note: Cars can still be identified without the key, but the technical assistant will be disabled.""")
 
 
-try:
-    vision_model, class_names, idx_to_class = load_vision_model()
-    rag_db = load_rag_system()
-    custom_success("BMW Identification Model & Info Database Connected")
-except FileNotFoundError as e:
-    st.error(f"❌ Missing File: {e}")
-    st.stop()
+pipeline = load_pipeline()
+
+# Re-checks every second while models load, then reruns the page once so the
+# finished status replaces it
+startup_polling = not pipeline.all_done()
+
+@st.fragment(run_every=1.0 if startup_polling else None)
+def show_startup_status(polling):
+    if polling and pipeline.all_done():
+        st.rerun()
+    status = pipeline.status()
+    for name, (state, seconds, error) in status.items():
+        if state == FAILED:
+            if isinstance(error, FileNotFoundError):
+                st.error(f"❌ Missing File: {error}")
+            else:
+                st.error(f"❌ {STARTUP_LABELS.get(name, name)} failed to load: {error}")
+    if all(state == READY for state, _, _ in status.values()):
+        custom_success("BMW Identification Model & Info Database Connected")
+    elif not pipeline.all_done():
+        loading = [f"{STARTUP_LABELS.get(name, name)} ({seconds:.0f}s)" for name, (state, seconds, _) in status.items()
+                   if state != READY and state != FAILED]
+        st.info("⏳ Warming up: " + ", ".join(loading) + ". You can already upload a photo.")
+
+show_startup_status(startup_polling)
+
+def wait_for(name, message):
+    # Only blocks (behind a spinner) if the component is still loading
+    if pipeline.state(name) != READY:
+        with st.spinner(message):
+            try:
+                pipeline.wait(name)
+            except FileNotFoundError as e:
+                st.error(f"❌ Missing File: {e}")
+                st.stop()
+            except Exception as e:
+                # The status banner was drawn before this load finished
+                st.error(f"❌ {STARTUP_LABELS.get(name, name)} failed to load: {e}")
+                st.stop()
 
 # --- GENERATE CHASSIS OVERRIDE LIST ---
-# 1. Get all unique model names that are NOT non-car/non-BMW
-unique_model_names = sorted(list(set(format_class_name(c) for c in class_names if 'non' not in c.lower())))
+# Needs the class names, so it is only built once a prediction exists
+def chassis_override_list():
+    # 1. All BMW model names, sorted (precomputed in the class table)
+    unique_model_names = run_vision(pipeline.class_table).override_options()
 
-# 2. Insert utility options at the top
-unique_model_names.insert(0, "Model Correct - Proceed") 
-unique_model_names.insert(2, "Non-BMW/Incorrect Image")
+    # 2. Insert utility options at the top
+    unique_model_names.insert(0, "Model Correct - Proceed") 
+    unique_model_names.insert(2, "Non-BMW/Incorrect Image")
+    return unique_model_names
 
-CHASSIS_OVERRIDE_LIST = unique_model_names
 col1, col2 = st.columns([1, 2])
 
-# Define Scope Lists (Used for the UI only)
-SUPPORTED_MODELS = [
-    "E30", "E36", "E46", 
-    "E28", "E34", "E39", 
-    "E24", 
-    "E23", "E32", "E38", 
-    "E31", 
-    "Z3", "Z8", 
-    "E53"
-]
-
 # Initialize Session State
 if 'app_state' not in st.session_state: st.session_state['app_state'] = 'idle'
 if 'current_car_raw' not in st.session_state: st.session_state['current_car_raw'] = None
@@ -476,7 +326,7 @@ def handle_override_change():
     else:
         # User selected a specific model name (e.g., 'BMW E36 Coupe').
         # We must extract the chassis code from this string for RAG filtering.
-        new_chassis_code = extract_chassis_code(selected_option)
+        new_chassis_code = pipeline.class_table().chassis_for_display(selected_option)
         
         st.session_state['chassis_code'] = new_chassis_code
         st.session_state['current_car_display'] = selected_option # Set full name for display
@@ -491,7 +341,14 @@ with col1:
     if uploaded_file is not None:
         image_bytes = uploaded_file.getvalue()
         current_hash = hashlib.sha256(image_bytes).hexdigest()
-        image = Image.open(uploaded_file).convert('RGB')
+        try:
+            image = decode_image(image_bytes)
+        except ImageTooLarge as e:
+            st.error(f"⛔ This image is too large to process. {e}")
+            st.stop()
+        except (UnidentifiedImageError, OSError):
+            st.error("⛔ This file could not be read as an image.")
+            st.stop()
 
         # --- PREDICTION LOGIC PROTECTION ---
         if current_hash != st.session_state['prediction_hash'] or not st.session_state['is_override_active']:
@@ -500,12 +357,15 @@ with col1:
             st.session_state['is_override_active'] = False
             
             # --- RUN MODEL ---
-            result = robust_process_image(image, vision_model, class_names, idx_to_class)
+            wait_for("vision", "Loading the identification model...")
+            result = run_vision(pipeline.classify, image_bytes, image)
             
             # --- STORE INITIAL PREDICTION STATE ---
+            class_table = pipeline.class_table()
             top_car_raw = result['display_name']
-            top_car_display = format_class_name(top_car_raw)
-            original_chassis = extract_chassis_code(top_car_raw)
+            top_class = class_table.by_index(result['class_index'], top_car_raw)
+            top_car_display = top_class.display_name
+            original_chassis = top_class.chassis_code
             
             st.session_state['initial_chassis_code'] = original_chassis
             st.session_state['initial_car_display'] = top_car_display
@@ -518,10 +378,11 @@ with col1:
             
             # --- UI VISUALS & WARNINGS ---
             category_score = result['category_score']
-            is_supported = any(code in top_car_raw for code in SUPPORTED_MODELS)
+            is_supported = top_class.supported
             
             st.caption("Confidence Breakdown:")
-            chart_dict = {format_class_name(p[0]): p[1] for p in result['chart_data']}
+            chart_dict = {class_table.by_index(idx).display_name: p[1]
+                          for idx, p in zip(result['chart_indices'], result['chart_data'])}
             st.bar_chart(chart_dict)
             
             if not result['is_valid']:
@@ -540,9 +401,11 @@ with col1:
                     st.warning(f"⚠️ **General Mode:** Detected **{top_car_display}**. This model is outside our specialized database (1980s-2000s). Database retrieval will be attempted, but answers may be incorrect. Using general Wikipedia/Web knowledge.")
 
         # Display the current image regardless of whether processing was skipped
-        st.image(image, caption='Your Upload', use_container_width=True)
+        st.image(make_preview(image), caption='Your Upload', use_container_width=True)
 
 with col2:
+    if st.session_state['app_state'] in ('invalid', 'valid'):
+        CHASSIS_OVERRIDE_LIST = chassis_override_list()
     
     if st.session_state['app_state'] == 'invalid':
         display_name = st.session_state['current_car_display']
@@ -620,17 +483,24 @@ with col2:
                 
                 if query:
                     # The API key is guaranteed to be valid here
+                    # Spinner covers retrieval only; the answer streams in below
+                    wait_for("rag", "Loading the repair manual database...")
                     with st.spinner(f"Consulting manuals for {car_display}..."):
                         # Pass the API key from session state
-                        answer, sources = generate_answer(
-                            car_display, 
-                            query, 
-                            rag_db, 
-                            st.session_state['gemini_api_key'], 
-                            chassis_override=current_chassis
-                        )
+                        try:
+                            answer_stream, sources = pipeline.ask(
+                                car_display, 
+                                query, 
+                                st.session_state['gemini_api_key'], 
+                                chassis_override=current_chassis,
+                                stream=True
+                            )
+                        except requests.RequestException as e:
+                            show_pipeline_error(e)
+                            st.stop()
                     
-                    st.markdown(answer)
+                    # Reserve the answer's slot above the sources, render sources now
+                    answer_slot = st.container()
                     
                     if sources: 
                         with st.expander("View Source Documents (Evidence)"):
@@ -639,6 +509,9 @@ with col2:
                                 car_model_meta = doc.metadata.get('car_model', 'Unknown')
                                 st.markdown(f"**Reference {i+1} [{source_type} - {car_model_meta}]:**")
                                 st.caption(doc.page_content[:400] + "...")
+                    
+                    with answer_slot:
+                        st.write_stream(answer_stream)
                         
     else:
         st.info("👋 Waiting for image upload...")
\ No newline at end of file
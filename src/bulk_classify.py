@@ -0,0 +1,260 @@
+# --- BULK IMAGE CLASSIFICATION ---
+# Classifies a whole folder, .zip or .tar(.gz) of photos:
+#   main process   streams entries out of the source (archives are never unpacked)
+#   worker procs   draft-mode decode (image_io.py) + Resize(380) / CenterCrop(380)
+#   main process   normalizes each batch and runs the B4 model on it
+# and appends one JSON line per image, with the same fields robust_process_image
+# returns, to the output file. Corrupt files get an "error" line instead; a file
+# that crashes a worker process gets one too, and the pool is restarted.
+#
+# Re-running with the same --out resumes: images already in the output are skipped,
+# except those whose read failed with an I/O error ("retry": true), which are tried again.
+#
+#   cd src && python -m bulk_classify /path/to/dealer_dump.zip --out ../results/dump.jsonl
+import argparse
+import json
+import multiprocessing
+import os
+import tarfile
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from vision_backends import BACKEND_MODES, IMAGE_EXTENSIONS
+
+
+# --- SOURCES ---
+# Each yields (name, read()) for the images whose name is not in `done`.
+def iter_directory(root, done=()):
+    for folder, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(folder, name)
+                rel_path = os.path.relpath(path, root)
+                if rel_path not in done:
+                    yield rel_path, lambda p=path: _read(p)
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def iter_zip(path, done=()):
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            if (not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+                    and info.filename not in done):
+                yield info.filename, lambda i=info: archive.read(i)
+
+
+def iter_tar(path, done=()):
+    # Stream mode: one forward pass, works for .tar.gz without random access
+    with tarfile.open(path, mode="r|*") as archive:
+        for member in archive:
+            if (member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS)
+                    and member.name not in done):
+                # Must be read before the stream moves on to the next member;
+                # skipped members are never extracted
+                data = archive.extractfile(member).read()
+                yield member.name, lambda d=data: d
+
+
+def iter_source(path, done=()):
+    """(name, read()) pairs for the images not in `done`; those are never read."""
+    if os.path.isdir(path):
+        return iter_directory(path, done)
+    if zipfile.is_zipfile(path):
+        return iter_zip(path, done)
+    if tarfile.is_tarfile(path):
+        return iter_tar(path, done)
+    raise ValueError(f"Not a directory, zip or tar archive: {path}")
+
+
+# --- RESUME ---
+def load_done(out_path):
+    """Names already in the output; drops a half-written last line from an interrupted run.
+
+    Lines marked "retry" (the read itself failed, e.g. a flaky network mount) don't count.
+    """
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, 'rb') as f:
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    if len(complete) != len(data):
+        with open(out_path, 'wb') as f:
+            f.write(complete)
+    done = set()
+    for line in complete.splitlines():
+        try:
+            record = json.loads(line)
+            if not record.get("retry"):
+                done.add(record["path"])
+        except (ValueError, KeyError):
+            continue
+    return done
+
+
+# --- WORKERS ---
+def decode_and_resize(name, data):
+    """Runs in a worker process: bytes -> uint8 (380, 380, 3), or an error message."""
+    from PIL import UnidentifiedImageError
+    from image_io import decode_image
+    from vision import resize_crop
+
+    try:
+        return name, resize_crop(decode_image(data)), None
+    except UnidentifiedImageError:
+        return name, None, "not a readable image"
+    except Exception as e:
+        return name, None, f"{type(e).__name__}: {e}"
+
+
+def _warm_worker():
+    # Only here to pay the torch/torchvision import when the worker starts,
+    # not inside its first task
+    import vision
+    return vision.IMAGE_SIZE
+
+
+def _new_pool(workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker,
+                               # Never fork a process whose torch thread pool is already running
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+# --- MAIN LOOP ---
+def classify_stream(source_path, out_path, model, classes, groups, workers=4, batch_size=16, prefetch=None):
+    from vision import classify_tensors, normalize_batch
+
+    done = load_done(out_path)
+    if done:
+        print(f"Resuming: {len(done)} images already in {out_path}")
+    source = iter_source(source_path, done)
+
+    stats = {"classified": 0, "skipped": len(done), "failed": 0, "pool_restarts": 0}
+    start = time.perf_counter()
+    # Bounded window of in-flight decodes, so a huge archive never sits in memory at once
+    window = prefetch or workers * 4
+    batch_names, batch_arrays = [], []
+
+    pool = _new_pool(workers)
+    with open(out_path, 'a', encoding='utf-8') as out:
+
+        def flush():
+            if not batch_names:
+                return
+            results = classify_tensors(normalize_batch(batch_arrays), model, classes, groups)
+            for name, result in zip(batch_names, results):
+                out.write(json.dumps({"path": name, **result}) + "\n")
+            out.flush()
+            stats["classified"] += len(batch_names)
+            batch_names.clear()
+            batch_arrays.clear()
+            elapsed = time.perf_counter() - start
+            print(f"  {stats['classified']} classified, {stats['failed']} failed "
+                  f"({stats['classified'] / elapsed:.1f} img/s)", end="\r")
+
+        def record(name, array, error):
+            if error is not None:
+                out.write(json.dumps({"path": name, "error": error}) + "\n")
+                stats["failed"] += 1
+                return
+            batch_names.append(name)
+            batch_arrays.append(array)
+            if len(batch_names) >= batch_size:
+                flush()
+
+        def restart_pool():
+            nonlocal pool
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = _new_pool(workers)
+            stats["pool_restarts"] += 1
+
+        def isolate(entries):
+            # One at a time, so a second crash pins down the file that causes it
+            for name, data in entries:
+                try:
+                    record(*pool.submit(decode_and_resize, name, data).result())
+                except BrokenProcessPool:
+                    restart_pool()
+                    record(name, None, "worker process crashed decoding this image")
+
+        def collect():
+            name, data, future = pending.popleft()
+            try:
+                record(*future.result())
+            except BrokenProcessPool:
+                # A worker died hard (decoder segfault, OOM kill): every decode still
+                # in flight died with the pool; keep the finished ones, retry the rest
+                retry = [(name, data)]
+                for other_name, other_data, other in pending:
+                    if other.done() and other.exception() is None:
+                        record(*other.result())
+                    else:
+                        retry.append((other_name, other_data))
+                pending.clear()
+                restart_pool()
+                isolate(retry)
+
+        pending = deque()
+        try:
+            for name, read in source:
+                try:
+                    data = read()
+                except OSError as e:
+                    out.write(json.dumps({"path": name, "error": f"{type(e).__name__}: {e}", "retry": True}) + "\n")
+                    stats["failed"] += 1
+                    continue
+                pending.append((name, data, pool.submit(decode_and_resize, name, data)))
+                if len(pending) >= window:
+                    collect()
+            while pending:
+                collect()
+            flush()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"\n✅ {stats['classified']} classified, {stats['failed']} failed, {stats['skipped']} already done "
+          f"in {elapsed:.0f}s -> {out_path}")
+    if stats["pool_restarts"]:
+        print(f"⚠️ Restarted the decode pool {stats['pool_restarts']} time(s) after a worker crashed")
+    return stats
+
+
+def main():
+    import torch
+    import pipeline
+    from vision_backends import load_backend_classifier
+
+    parser = argparse.ArgumentParser(description="Classify every image in a folder, zip or tar archive.")
+    parser.add_argument("source", help="Directory, .zip or .tar(.gz)")
+    parser.add_argument("--out", required=True, help="JSONL output (appended to / resumed from)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="Decode/resize worker processes")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads for the model")
+    parser.add_argument("--backend", choices=BACKEND_MODES, default=pipeline.VISION_BACKEND)
+    parser.add_argument("--artifact", default=pipeline.VISION_BACKEND_ARTIFACT)
+    parser.add_argument("--model", default=pipeline.MODEL_PATH)
+    parser.add_argument("--classes", default=pipeline.CLASS_JSON_PATH)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model, classes, _, groups = load_backend_classifier(
+        args.backend, args.model, args.classes,
+        artifact_path=args.artifact, calibration_dir=pipeline.VISION_CALIBRATION_DIR
+    )
+    out_dir = os.path.dirname(os.path.abspath(args.out))
+    os.makedirs(out_dir, exist_ok=True)
+    classify_stream(args.source, args.out, model, classes, groups,
+                    workers=args.workers, batch_size=args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# --- CLASS METADATA TABLE ---
+# Everything the UI and retrieval need to know about a classifier class,
+# derived once from the class map instead of re-scanning class-name strings
+# on every Streamlit rerun:
+#   index -> display name, chassis code (the car_model tag used for retrieval),
+#            supported flag (specialised manuals exist), BMW / non-BMW group
+#
+# Print the table (tests/test_class_metadata.py checks it against the old
+# string-scanning helpers):
+#   cd src && python -m class_metadata
+import argparse
+import json
+
+# The car_model tags ingest.py assigns to documents. ingest matches them in
+# this order, so "E36-7"/"E36-8" (Z3) must stay ahead of "E36".
+CHASSIS_CODES = [
+    "E24", "E28", "E30", "E31", "E32", "E34",
+    "E36-7", "E36-8", "E36",
+    "E38", "E39", "E46",
+    "E52", "E53", "E83",
+    "Z1", "Z3", "Z8", "X5"
+]
+# Model names rather than chassis codes; "BMW_E53_X5" is an E53
+MODEL_ALIASES = {"Z1", "Z3", "Z8", "X5"}
+
+# Chassis with detailed repair manuals in the database (1980s-2000s)
+SUPPORTED_CODES = [
+    "E30", "E36", "E46",
+    "E28", "E34", "E39",
+    "E24",
+    "E23", "E32", "E38",
+    "E31",
+    "Z3", "Z8",
+    "E53"
+]
+
+
+def extract_chassis_code(name):
+    """Chassis code mentioned in a class name or free text, or None.
+
+    Independent of list order: the longest code wins ("E36-7" over "E36"),
+    then a real chassis code over a model name ("E53" over "X5"), then the
+    one that comes first in the text.
+    """
+    upper = name.upper()
+    best = None
+    for code in CHASSIS_CODES:
+        position = upper.find(code)
+        if position < 0:
+            continue
+        rank = (-len(code), code in MODEL_ALIASES, position)
+        if best is None or rank < best[0]:
+            best = (rank, code)
+    return best[1] if best else None
+
+
+def format_class_name(raw_name):
+    if raw_name == "non_bmw_cars":
+        return "Non-BMW Car"
+    if raw_name == "non_cars":
+        return "Not a Vehicle"
+    return raw_name.replace("_", " ")
+
+
+def is_bmw_class(raw_name):
+    return "non" not in raw_name.lower()
+
+
+def is_supported(raw_name):
+    return any(code in raw_name for code in SUPPORTED_CODES)
+
+
+class ClassInfo:
+    __slots__ = ("index", "name", "display_name", "chassis_code", "supported", "is_bmw")
+
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+        self.display_name = format_class_name(name)
+        self.is_bmw = is_bmw_class(name)
+        self.chassis_code = extract_chassis_code(name) if self.is_bmw else None
+        self.supported = self.is_bmw and is_supported(name)
+
+
+class ClassTable:
+    """ClassInfo per class index, plus O(1) lookups by raw and display name."""
+
+    def __init__(self, class_names):
+        self.entries = [ClassInfo(index, name) for index, name in enumerate(class_names)]
+        self._by_name = {info.name: info for info in self.entries}
+        self._by_display = {info.display_name: info for info in self.entries}
+        self._override_options = sorted(info.display_name for info in self.entries if info.is_bmw)
+
+    @classmethod
+    def from_class_map(cls, class_json_path):
+        with open(class_json_path, 'r') as f:
+            class_map = json.load(f)
+        return cls([class_map[str(i)] for i in range(len(class_map))])
+
+    def __getitem__(self, index):
+        return self.entries[index]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def by_index(self, index, raw_name=None):
+        """Entry for a decision's class_index; -1 ("Unknown Non-BMW") gets an ad-hoc one."""
+        return self.entries[index] if index >= 0 else ClassInfo(-1, raw_name or "Unknown Non-BMW")
+
+    def lookup(self, raw_name):
+        """Entry for a raw class name; names outside the map (e.g. "Unknown Non-BMW") get an ad-hoc one."""
+        info = self._by_name.get(raw_name)
+        return info if info is not None else ClassInfo(-1, raw_name)
+
+    def chassis_for_display(self, display_name):
+        info = self._by_display.get(display_name)
+        return info.chassis_code if info is not None else extract_chassis_code(display_name)
+
+    def override_options(self):
+        """Display names of all BMW classes, sorted, for the manual override box."""
+        return list(self._override_options)
+
+
+def main():
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Print the class metadata table.")
+    parser.add_argument("--classes", default=pipeline.CLASS_JSON_PATH)
+    args = parser.parse_args()
+
+    table = ClassTable.from_class_map(args.classes)
+    for info in table.entries:
+        print(f"{info.index:>4}  {info.display_name:<40} {str(info.chassis_code):<7} "
+              f"{'supported' if info.supported else '':<10} {'BMW' if info.is_bmw else 'non-BMW'}")
+    print(f"\n{len(table)} classes, {sum(info.is_bmw for info in table.entries)} BMW, "
+          f"{sum(info.supported for info in table.entries)} supported")
+
+
+if __name__ == "__main__":
+    main()
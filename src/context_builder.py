@@ -0,0 +1,111 @@
+# --- CONTEXT ASSEMBLY ---
+# Turns retrieved chunks (in relevance order) into the prompt context:
+#   1. drop near-duplicates (word-shingle Jaccard - exact, and cheap at k <= ~20)
+#   2. merge adjacent chunks of the same source/page, removing the splitter overlap
+#   3. fill a token budget in relevance order
+# and reports how many prompt tokens that saved versus joining everything verbatim.
+import re
+
+# Rough chars-per-token for Gemini on English technical text
+CHARS_PER_TOKEN = 4
+SHINGLE_SIZE = 5
+DUPLICATE_THRESHOLD = 0.8
+# Shortest suffix/prefix overlap treated as "these two chunks are contiguous"
+MIN_OVERLAP_CHARS = 50
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def format_chunk(doc):
+    return f"[Source: {doc.metadata.get('car_model', 'Unknown')}] {doc.page_content}"
+
+
+def _shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def drop_near_duplicates(docs, threshold=DUPLICATE_THRESHOLD):
+    kept, kept_shingles = [], []
+    for doc in docs:
+        shingles = _shingles(doc.page_content)
+        if any(_jaccard(shingles, other) >= threshold for other in kept_shingles):
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _overlap(left, right, max_check=400):
+    """Length of the longest suffix of `left` that is a prefix of `right`."""
+    for size in range(min(len(left), len(right), max_check), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _same_source(a, b):
+    if not (a.metadata.get("source") or a.metadata.get("filename")):
+        return False
+    return all(a.metadata.get(k) == b.metadata.get(k) for k in ("source", "filename", "page"))
+
+
+def merge_adjacent(docs):
+    """Merge chunks that continue each other (same source/page, overlapping text).
+
+    The merged chunk keeps the position of its most relevant part.
+    """
+    merged = []
+    for doc in docs:
+        for i, existing in enumerate(merged):
+            if not _same_source(existing, doc):
+                continue
+            if (overlap := _overlap(existing.page_content, doc.page_content)):
+                text = existing.page_content + doc.page_content[overlap:]
+            elif (overlap := _overlap(doc.page_content, existing.page_content)):
+                text = doc.page_content + existing.page_content[overlap:]
+            else:
+                continue
+            merged[i] = existing.__class__(page_content=text, metadata=existing.metadata)
+            break
+        else:
+            merged.append(doc)
+    return merged
+
+
+def build_context(docs, token_budget=2000):
+    """Return (context_text, used_docs, stats) for docs in relevance order."""
+    tokens_in = sum(estimate_tokens(format_chunk(d)) for d in docs)
+
+    unique = drop_near_duplicates(docs)
+    merged = merge_adjacent(unique)
+
+    used, tokens_out = [], 0
+    for doc in merged:
+        cost = estimate_tokens(format_chunk(doc))
+        if used and tokens_out + cost > token_budget:
+            continue  # a later, shorter chunk may still fit
+        used.append(doc)
+        tokens_out += cost
+
+    stats = {
+        "chunks_in": len(docs),
+        "duplicates_dropped": len(docs) - len(unique),
+        "chunks_merged": len(unique) - len(merged),
+        "chunks_out": len(used),
+        "tokens_in": tokens_in,
+        "tokens_out": tokens_out,
+        "tokens_saved": max(0, tokens_in - tokens_out),
+    }
+    context_text = "\n\n".join(format_chunk(d) for d in used)
+    return context_text, used, stats
@@ -0,0 +1,372 @@
+# --- QUERY EMBEDDING SERVICE ---
+# Every question is embedded once, then used for retrieval and for the
+# semantic answer cache lookup. This layer sits in front of MiniLM:
+#   - an in-process LRU of normalized question text -> vector
+#   - an optional float16 vector cache in a memory-mapped file, which
+#     survives restarts and is shared by all worker processes on a machine
+#   - micro-batching: questions embedded concurrently on different threads
+#     share one forward pass (same scheme as inference_engine.py)
+#   - an optional ONNX Runtime backend (fp32 or dynamic int8) instead of torch
+#
+# QueryEmbedder has embed_query / embed_documents, so it is handed to Chroma
+# as its embedding function and retrieval picks it up via db.embeddings.
+#
+# Export MiniLM to ONNX and check it against the torch model:
+#   python -m embedding_service --export ../models/minilm_onnx
+import argparse
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+from metrics import EMBED_BATCH_SIZE, cache_result, span
+
+EMBED_BACKENDS = ["torch", "onnx", "onnx_int8"]
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model_int8.onnx"
+MAX_SEQ_LENGTH = 256  # all-MiniLM-L6-v2's sentence-transformers limit
+
+
+def normalize_query(text):
+    # MiniLM's tokenizer is uncased and splits on whitespace, so this key
+    # embeds to exactly the same vector as the original text
+    return " ".join(text.split()).lower()
+
+
+# --- BACKENDS ---
+# A backend maps a list of texts to a float32 (N, dim) array of unit vectors.
+class TorchBackend:
+    """sentence-transformers through langchain, exactly as ingest.py embeds the chunks."""
+
+    def __init__(self, model_name, shared_weights_path=None):
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self._embeddings = HuggingFaceEmbeddings(model_name=model_name)
+        if shared_weights_path:
+            from workers import share_module_weights
+
+            # Worker processes on one host then share one copy of MiniLM
+            share_module_weights(self._embeddings._client, shared_weights_path)
+
+    def __call__(self, texts):
+        return np.asarray(self._embeddings.embed_documents(texts), dtype=np.float32)
+
+
+class OnnxBackend:
+    """MiniLM exported by export_onnx(): tokenizer + onnxruntime, mean pooling, L2 norm."""
+
+    def __init__(self, model_dir, int8=False, num_threads=None):
+        import onnxruntime as ort  # optional dependency, only needed for this backend
+        from transformers import AutoTokenizer
+
+        path = os.path.join(model_dir, ONNX_INT8_FILE if int8 else ONNX_FILE)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found; run `python -m embedding_service --export {model_dir}`")
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+
+    def __call__(self, texts):
+        tokens = self.tokenizer(texts, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np")
+        hidden = self.session.run(None, {name: tokens[name].astype(np.int64) for name in self.input_names})[0]
+        mask = tokens["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+
+def build_backend(mode, model_name, onnx_dir=None, num_threads=None, shared_weights_path=None):
+    if mode == "torch":
+        return TorchBackend(model_name, shared_weights_path=shared_weights_path)
+    if mode in ("onnx", "onnx_int8"):
+        return OnnxBackend(onnx_dir, int8=mode == "onnx_int8", num_threads=num_threads)
+    raise ValueError(f"Unknown embedding backend: {mode}")
+
+
+def export_onnx(model_name, out_dir, int8=True):
+    """Write <out_dir>/model.onnx (+ model_int8.onnx) and the tokenizer for OnnxBackend."""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    hf_name = model_name if "/" in model_name else f"sentence-transformers/{model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(hf_name)
+    model = AutoModel.from_pretrained(hf_name).eval()
+
+    class Encoder(torch.nn.Module):
+        # Token embeddings only; pooling happens in OnnxBackend
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask,
+                              token_type_ids=token_type_ids).last_hidden_state
+
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer.save_pretrained(out_dir)
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    example = tokenizer(["warm up"], return_tensors="pt")
+    path = os.path.join(out_dir, ONNX_FILE)
+    torch.onnx.export(
+        Encoder(model), tuple(example[n] for n in names), path,
+        input_names=names, output_names=["last_hidden_state"],
+        dynamic_axes={n: {0: "batch", 1: "tokens"} for n in names + ["last_hidden_state"]},
+        opset_version=17
+    )
+    if int8:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(path, os.path.join(out_dir, ONNX_INT8_FILE), weight_type=QuantType.QInt8)
+    return out_dir
+
+
+# --- DISK CACHE ---
+def _tag(key):
+    # 64-bit key hash; 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+
+class VectorCache:
+    """Fixed-size float16 vectors in memory-mapped .npy files, shared across processes.
+
+    Direct-mapped: the key hash picks the slot and a colliding key overwrites
+    it, so there is nothing to index, compact or lock. The slot tag is cleared
+    while a vector is rewritten and re-checked after a read, so a reader never
+    returns a half-written vector.
+    """
+
+    def __init__(self, path, capacity=32768):
+        self.path = path
+        self.capacity = capacity
+        self._tags = None
+        self._vectors = None
+
+    def _open(self, dim=None):
+        if self._vectors is not None:
+            return True
+        if not os.path.exists(self.path):
+            if dim is None:
+                return False
+            self._create(dim)
+        self._tags = np.load(os.path.join(self.path, "tags.npy"), mmap_mode="r+")
+        self._vectors = np.load(os.path.join(self.path, "vectors.npy"), mmap_mode="r+")
+        self.capacity = len(self._tags)
+        return True
+
+    def _create(self, dim):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        np.lib.format.open_memmap(os.path.join(tmp, "tags.npy"), mode="w+", dtype=np.uint64, shape=(self.capacity,))
+        np.lib.format.open_memmap(os.path.join(tmp, "vectors.npy"), mode="w+", dtype=np.float16,
+                                  shape=(self.capacity, dim))
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            # Another process created it first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def get(self, key):
+        if not self._open():
+            return None
+        tag = _tag(key)
+        slot = tag % self.capacity
+        if self._tags[slot] != tag:
+            return None
+        vector = self._vectors[slot].astype(np.float32)
+        if self._tags[slot] != tag:
+            return None
+        return vector
+
+    def put(self, key, vector):
+        if not self._open(len(vector)) or len(vector) != self._vectors.shape[1]:
+            return
+        tag = _tag(key)
+        slot = tag % self.capacity
+        self._tags[slot] = 0
+        self._vectors[slot] = vector
+        self._tags[slot] = tag
+
+
+# --- THE SERVICE ---
+class QueryEmbedder:
+    """Cached, micro-batched question embedding; usable as a LangChain embedding function.
+
+    Concurrent calls are grouped into batches of at most `max_batch_size`,
+    waiting at most `max_wait_ms` for company. Concurrent calls for the same
+    question share one embedding.
+    """
+
+    def __init__(self, backend, cache_entries=4096, vector_cache=None, max_batch_size=16, max_wait_ms=5):
+        self.backend = backend
+        self.cache_entries = cache_entries
+        self.vector_cache = vector_cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+        self._worker.start()
+
+    # --- PUBLIC API ---
+    def submit(self, text):
+        """Return a Future resolving to the float32 unit vector of `text`."""
+        self._check_open()
+        key = normalize_query(text)
+        future = Future()
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is None and self.vector_cache is not None:
+                vector = self.vector_cache.get(key)
+                if vector is not None:
+                    self._remember(key, vector)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                cache_result("embedding", hit=True)
+                future.set_result(vector)
+                return future
+            self.misses += 1
+            cache_result("embedding", hit=False)
+            if key in self._inflight:
+                return self._inflight[key]
+            # Under the lock close() queues the shutdown marker with
+            self._check_open()
+            self._inflight[key] = future
+            self._queue.put((key, future))
+        return future
+
+    def embed_query(self, text):
+        return self.submit(text).result().tolist()
+
+    def embed_documents(self, texts):
+        # Documents are embedded in bulk by ingest.py; no point caching them here
+        return self.backend(list(texts)).tolist()
+
+    def embed_uncached(self, text):
+        """One forward pass, bypassing caches and batching (for benchmarks)."""
+        return self.backend([normalize_query(text)])[0]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- INTERNALS ---
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("QueryEmbedder is closed")
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.cache_entries:
+            self._memory.popitem(last=False)
+
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._collect_batch(first)
+            try:
+                EMBED_BATCH_SIZE.observe(len(batch))
+                with span("embed_forward", batch_size=len(batch)):
+                    vectors = self.backend([key for key, _ in batch])
+            except Exception as e:
+                with self._lock:
+                    for key, future in batch:
+                        self._inflight.pop(key, None)
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                for (key, _), vector in zip(batch, vectors):
+                    self._remember(key, vector)
+                    if self.vector_cache is not None:
+                        self.vector_cache.put(key, vector)
+                    self._inflight.pop(key, None)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+
+# --- EXPORT + CHECK CLI ---
+SAMPLE_QUESTIONS = [
+    "What is the oil capacity of the N52 engine?",
+    "Front control arm bushing torque specs",
+    "How do I reset the service indicator?",
+    "M54B30 vanos solenoid replacement",
+    "Why does my E46 overheat in traffic?",
+    "Recommended tire pressure for 18 inch wheels",
+]
+
+
+def main():
+    import pipeline
+
+    parser = argparse.ArgumentParser(description="Export MiniLM to ONNX and compare it with the torch model.")
+    parser.add_argument("--export", metavar="DIR", help="Write model.onnx / model_int8.onnx + tokenizer here")
+    parser.add_argument("--onnx-dir", default=pipeline.EMBED_ONNX_DIR)
+    parser.add_argument("--modes", default="onnx,onnx_int8", help="Backends to compare against torch")
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+
+    onnx_dir = args.onnx_dir
+    if args.export:
+        onnx_dir = export_onnx(pipeline.EMBEDDING_MODEL, args.export)
+        print(f"✅ Exported {pipeline.EMBEDDING_MODEL} to {onnx_dir}")
+
+    reference = TorchBackend(pipeline.EMBEDDING_MODEL)
+    expected = reference(SAMPLE_QUESTIONS)
+    for mode in ["torch"] + args.modes.split(","):
+        backend = reference if mode == "torch" else build_backend(mode, pipeline.EMBEDDING_MODEL, onnx_dir)
+        vectors = backend(SAMPLE_QUESTIONS)
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            backend([SAMPLE_QUESTIONS[i % len(SAMPLE_QUESTIONS)]])
+        ms = (time.perf_counter() - start) * 1000 / args.iterations
+        cosine = float(np.min(np.sum(vectors * expected, axis=1)))
+        print(f"  {mode:<10} {ms:7.1f} ms/query   min cosine vs torch {cosine:.4f}")
+    print("Switch BMW_EMBED_BACKEND only if the cosine stays above ~0.99; the stored chunk vectors come from torch.")
+
+
+if __name__ == "__main__":
+    main()
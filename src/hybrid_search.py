@@ -0,0 +1,317 @@
+# --- HYBRID BM25 + VECTOR RETRIEVAL ---
+# MiniLM embeddings blur exact tokens (part numbers, fault codes, "M54B30").
+# A BM25 inverted index, partitioned per car_model and stored next to the
+# Chroma files, catches those. Its ranking is fused with the vector ranking
+# (reciprocal rank fusion), and the fused candidates can optionally be
+# reranked by a small CPU cross-encoder while the latency budget allows.
+#
+# The index is stored in <db>/bm25/ as plain data (a JSON manifest of doc ids
+# and terms, plus one .npz of posting arrays per partition), so loading it
+# never executes code from the DB folder.
+#
+# Build or refresh the index after ingestion:
+#   cd src && python -m hybrid_search --db-path ../models/bmw_knowledge_db_rag_paddleocr
+import argparse
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter, defaultdict
+
+import numpy as np
+
+from metrics import span
+
+INDEX_DIR = "bm25"
+INDEX_MANIFEST = "index.json"
+INDEX_VERSION = 1
+ALL_MODELS = "*"  # partition holding every chunk, used by the global strategy
+
+# Keeps part numbers / codes whole ("11-42-7-508-969", "m54b30", "p0171")
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        # Also index the pieces so "11-42-7-508-969" matches "11427508969" style queries loosely
+        parts = re.split(r"[-_./]", token)
+        if len(parts) > 1:
+            tokens.extend(p for p in parts if p)
+            tokens.append("".join(parts))
+    return tokens
+
+
+class BM25Partition:
+    """Inverted index over one car_model partition (Okapi BM25)."""
+
+    def __init__(self, doc_ids, doc_lens, postings, idf, k1=1.5, b=0.75):
+        self.doc_ids = doc_ids
+        self.doc_lens = doc_lens
+        self.postings = postings  # term -> (doc indices, term frequencies)
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(doc_lens.mean()) if len(doc_ids) else 0.0
+
+    @classmethod
+    def build(cls, doc_ids, token_lists, k1=1.5, b=0.75):
+        doc_lens = np.array([len(t) for t in token_lists], dtype=np.float32)
+        collected = defaultdict(lambda: ([], []))
+        for doc_idx, tokens in enumerate(token_lists):
+            for term, tf in Counter(tokens).items():
+                collected[term][0].append(doc_idx)
+                collected[term][1].append(tf)
+
+        n = len(doc_ids)
+        postings = {}
+        idf = {}
+        for term, (idx, tf) in collected.items():
+            postings[term] = (np.array(idx, dtype=np.int32), np.array(tf, dtype=np.float32))
+            df = len(idx)
+            idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        return cls(doc_ids, doc_lens, postings, idf, k1, b)
+
+    def to_arrays(self):
+        """(terms, arrays): the postings flattened into CSR-style arrays for np.savez."""
+        terms = list(self.postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(self.postings[t][0]) for t in terms])
+        empty = (np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32))
+        arrays = {
+            "doc_lens": self.doc_lens,
+            "offsets": offsets,
+            "doc_idx": np.concatenate([self.postings[t][0] for t in terms] or [empty[0]]),
+            "tf": np.concatenate([self.postings[t][1] for t in terms] or [empty[1]]),
+            "idf": np.array([self.idf[t] for t in terms], dtype=np.float64),
+        }
+        return terms, arrays
+
+    @classmethod
+    def from_arrays(cls, doc_ids, terms, arrays, k1=1.5, b=0.75):
+        offsets, doc_idx, tf, idf = arrays["offsets"], arrays["doc_idx"], arrays["tf"], arrays["idf"]
+        postings = {}
+        idf_by_term = {}
+        for i, term in enumerate(terms):
+            start, end = offsets[i], offsets[i + 1]
+            postings[term] = (doc_idx[start:end], tf[start:end])
+            idf_by_term[term] = float(idf[i])
+        return cls(doc_ids, arrays["doc_lens"], postings, idf_by_term, k1, b)
+
+    def search(self, query_tokens, top_n):
+        if not self.doc_ids:
+            return []
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lens / self.avgdl)
+        for term in set(query_tokens):
+            if term not in self.postings:
+                continue
+            idx, tf = self.postings[term]
+            scores[idx] += self.idf[term] * tf * (self.k1 + 1) / (tf + norm[idx])
+
+        top_n = min(top_n, int((scores > 0).sum()))
+        if top_n == 0:
+            return []
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best])]
+        return [(self.doc_ids[i], float(scores[i])) for i in best]
+
+
+class BM25Index:
+    def __init__(self, partitions, doc_count):
+        self.partitions = partitions
+        self.doc_count = doc_count
+
+    @classmethod
+    def from_chroma(cls, db, page_size=5000):
+        """Read every chunk out of the Chroma collection and index it."""
+        by_model = defaultdict(lambda: ([], []))
+        offset = 0
+        while True:
+            page = db.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            for doc_id, text, meta in zip(page["ids"], page["documents"], page["metadatas"]):
+                tokens = tokenize(text or "")
+                car_model = (meta or {}).get("car_model", "Unknown")
+                for key in (car_model, ALL_MODELS):
+                    by_model[key][0].append(doc_id)
+                    by_model[key][1].append(tokens)
+            offset += len(page["ids"])
+
+        partitions = {key: BM25Partition.build(ids, tokens) for key, (ids, tokens) in by_model.items()}
+        return cls(partitions, offset)
+
+    def search(self, query, top_n, car_model=None):
+        partition = self.partitions.get(car_model or ALL_MODELS)
+        if partition is None:
+            return []
+        return partition.search(tokenize(query), top_n)
+
+    def save(self, db_path):
+        # Written next to the live index, then swapped, like the shards
+        root = os.path.join(db_path, INDEX_DIR)
+        staging = root + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        manifest = {"version": INDEX_VERSION, "doc_count": self.doc_count, "partitions": {}}
+        for i, (car_model, partition) in enumerate(self.partitions.items()):
+            filename = f"partition-{i}.npz"
+            terms, arrays = partition.to_arrays()
+            np.savez(os.path.join(staging, filename), **arrays)
+            manifest["partitions"][car_model] = {
+                "file": filename, "k1": partition.k1, "b": partition.b,
+                "doc_ids": partition.doc_ids, "terms": terms
+            }
+        with open(os.path.join(staging, INDEX_MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+
+        shutil.rmtree(root, ignore_errors=True)
+        os.replace(staging, root)
+
+    @classmethod
+    def load(cls, db_path):
+        root = os.path.join(db_path, INDEX_DIR)
+        path = os.path.join(root, INDEX_MANIFEST)
+        if not os.path.exists(path):
+            if os.path.exists(os.path.join(db_path, "bm25_index.pkl")):
+                print("⚠️ Ignoring the old pickled BM25 index; rebuild it with `python -m hybrid_search`")
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("version") != INDEX_VERSION:
+            print(f"⚠️ BM25 index version {manifest.get('version')} != {INDEX_VERSION}; rebuild it with `python -m hybrid_search`")
+            return None
+
+        partitions = {}
+        for car_model, entry in manifest["partitions"].items():
+            with np.load(os.path.join(root, entry["file"]), allow_pickle=False) as arrays:
+                arrays = {name: arrays[name] for name in arrays.files}
+            partitions[car_model] = BM25Partition.from_arrays(
+                entry["doc_ids"], entry["terms"], arrays, k1=entry["k1"], b=entry["b"]
+            )
+        return cls(partitions, manifest["doc_count"])
+
+
+def reciprocal_rank_fusion(rankings, weights, k=60):
+    """Fuse ranked id lists; returns ids sorted by fused score."""
+    fused = defaultdict(float)
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking):
+            fused[doc_id] += weight / (k + rank + 1)
+    return sorted(fused, key=fused.get, reverse=True)
+
+
+class HybridSearcher:
+    """Vector + BM25 fusion with an optional cross-encoder rerank under a latency budget."""
+
+    def __init__(self, db, bm25, candidates=20, vector_weight=1.0, bm25_weight=1.0,
+                 reranker_model=None, budget_ms=300):
+        self.db = db
+        self.bm25 = bm25
+        self.candidates = candidates
+        self.vector_weight = vector_weight
+        self.bm25_weight = bm25_weight
+        self.reranker_model = reranker_model
+        self.budget_ms = budget_ms
+        self._reranker = None
+        self._reranker_lock = threading.Lock()
+
+    def reranker(self):
+        """The cross-encoder, loaded once; call it at warm-up so no query pays the load."""
+        if self._reranker is None and self.reranker_model:
+            with self._reranker_lock:
+                if self._reranker is None:
+                    from sentence_transformers import CrossEncoder
+                    self._reranker = CrossEncoder(self.reranker_model, device="cpu")
+        return self._reranker
+
+    def search(self, question, question_embedding, k, search_filter=None, vector_search=None):
+        """`vector_search(embedding, k, filter)` overrides the Chroma vector search (e.g. shard routing)."""
+        start = time.perf_counter()
+        car_model = search_filter["car_model"] if search_filter else None
+
+        if vector_search is not None:
+            vector_hits = vector_search(question_embedding, self.candidates, search_filter)
+        else:
+            with span("vector_search", index="chroma"):
+                vector_hits = self.db.similarity_search_by_vector(question_embedding, k=self.candidates, filter=search_filter)
+        with span("bm25_search"):
+            keyword_hits = self.bm25.search(question, self.candidates, car_model=car_model)
+
+        # Chroma ids of vector hits (langchain_chroma sets Document.id)
+        docs_by_id = {d.id: d for d in vector_hits}
+        fused_ids = reciprocal_rank_fusion(
+            [[d.id for d in vector_hits], [doc_id for doc_id, _ in keyword_hits]],
+            [self.vector_weight, self.bm25_weight]
+        )
+
+        # Keyword-only hits are not loaded yet
+        missing = [doc_id for doc_id in fused_ids if doc_id not in docs_by_id]
+        if missing:
+            docs_by_id.update(self._fetch(missing))
+        fused = [docs_by_id[doc_id] for doc_id in fused_ids if doc_id in docs_by_id]
+
+        return self._rerank(question, fused, k, start)
+
+    def _fetch(self, ids):
+        from langchain_core.documents import Document
+
+        found = self.db.get(ids=ids, include=["documents", "metadatas"])
+        return {
+            doc_id: Document(id=doc_id, page_content=text, metadata=meta or {})
+            for doc_id, text, meta in zip(found["ids"], found["documents"], found["metadatas"])
+        }
+
+    def _rerank(self, question, docs, k, start, batch_size=8):
+        reranker = self.reranker()
+        if reranker is None or len(docs) <= 1:
+            return docs[:k]
+
+        # Score in small batches until the budget is spent; unscored docs keep fused order
+        scored = []
+        for i in range(0, len(docs), batch_size):
+            if (time.perf_counter() - start) * 1000 > self.budget_ms:
+                break
+            batch = docs[i:i + batch_size]
+            with span("rerank", batch_size=len(batch)):
+                scores = reranker.predict([(question, d.page_content) for d in batch])
+            scored.extend(zip(scores, batch))
+        if not scored:
+            return docs[:k]
+
+        reranked = [d for _, d in sorted(scored, key=lambda pair: pair[0], reverse=True)]
+        return (reranked + docs[len(scored):])[:k]
+
+
+def build_index(db_path, embedding_model="all-MiniLM-L6-v2"):
+    from langchain_chroma import Chroma
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    db = Chroma(persist_directory=db_path, embedding_function=HuggingFaceEmbeddings(model_name=embedding_model))
+    index = BM25Index.from_chroma(db)
+    index.save(db_path)
+    return index
+
+
+def main():
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+    default_db = os.path.join(os.path.dirname(current_folder), "models", "bmw_knowledge_db_rag_paddleocr")
+
+    parser = argparse.ArgumentParser(description="Build the BM25 keyword index next to the Chroma DB.")
+    parser.add_argument("--db-path", default=default_db)
+    args = parser.parse_args()
+
+    start = time.time()
+    index = build_index(args.db_path)
+    print(f"✅ Indexed {index.doc_count} chunks in {len(index.partitions) - 1} car_model partitions "
+          f"({time.time() - start:.0f}s) -> {os.path.join(args.db_path, INDEX_DIR)}")
+
+
+if __name__ == "__main__":
+    main()
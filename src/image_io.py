@@ -0,0 +1,56 @@
+# --- IMAGE DECODE FAST PATH ---
+# Phone photos are 12-48 MP, but the classifier only ever sees a 380px
+# center crop and the UI only shows a column-wide preview. decode_image():
+#   - reads the header first and refuses images whose decoded size would
+#     exceed the pixel limit, before any pixel data is decoded
+#   - JPEG: Image.draft() lets libjpeg decode at 1/2, 1/4 or 1/8 scale,
+#     keeping the short side >= 380 (a 12 MP photo decodes at ~0.75 MP)
+#   - other formats: decoded in full, then Image.reduce() box-downsamples
+#     by the largest integer factor that keeps the short side >= 380
+#   - applies the EXIF orientation, so portrait phone shots stand upright
+# The result goes through the usual Resize(380) / CenterCrop(380).
+#
+# Only PIL is imported here, so decoding never pulls in torch.
+import io
+
+from PIL import Image, ImageOps
+
+TARGET_SIDE = 380  # vision.IMAGE_SIZE
+PREVIEW_SIDE = 800
+MAX_DECODE_PIXELS = 40_000_000
+DECODE_VERSION = "draft-reduce-1"  # part of the prediction cache fingerprint
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def decode_image(data, min_side=TARGET_SIDE, max_pixels=MAX_DECODE_PIXELS):
+    """RGB, upright PIL image from encoded bytes, short side >= min_side (if the original was)."""
+    try:
+        image = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+
+    if image.format == "JPEG":
+        # Only changes the decoder's scale; nothing is decoded yet
+        image.draft("RGB", (min_side, min_side))
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageTooLarge(
+            f"Image is {width}x{height} ({width * height / 1e6:.0f} MP after scaling); "
+            f"the limit is {max_pixels / 1e6:.0f} MP"
+        )
+
+    image = ImageOps.exif_transpose(image).convert('RGB')
+    factor = min(image.size) // min_side
+    if factor >= 2:
+        image = image.reduce(factor)
+    return image
+
+
+def make_preview(image, max_side=PREVIEW_SIDE):
+    """Small copy for display; st.image would otherwise ship the full decode to the browser."""
+    preview = image.copy()
+    preview.thumbnail((max_side, max_side))
+    return preview
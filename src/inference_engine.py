@@ -0,0 +1,157 @@
+# --- BATCHED VISION INFERENCE ENGINE ---
+# Coalesces concurrent classification requests into micro-batches so bursts
+# of uploads share one B4 forward pass. Importable without Streamlit.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from metrics import VISION_BATCH_SIZE, VISION_TTA, span
+from vision import (TTA_MODES, average_tta, center_crop, decide_batch, decision_margins, load_classifier,
+                    predict_probs, preprocess, preprocess_resized)
+
+
+class VisionInferenceEngine:
+    """Reusable classifier that groups pending images into batches.
+
+    Requests wait at most `max_wait_ms` for company before the batch is run,
+    and a batch never exceeds `max_batch_size` images.
+
+    With tta="adaptive", images whose decision margin is below `tta_margin`
+    after the center-crop pass get a second pass over flipped / shifted
+    crops (one forward batch for all of them) and their probabilities are
+    averaged. tta="always" does that for every image.
+    """
+
+    def __init__(self, model, classes, groups, max_batch_size=8, max_wait_ms=10, tta="off", tta_margin=0.15):
+        if tta not in TTA_MODES:
+            raise ValueError(f"Unknown TTA mode: {tta}")
+        self.model = model
+        self.classes = classes
+        self.groups = groups
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.tta = tta
+        self.tta_margin = tta_margin
+        self.tta_checked = 0
+        self.tta_triggered = 0
+
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()  # nothing is queued behind the shutdown marker
+        self._worker = threading.Thread(target=self._run, name="vision-batcher", daemon=True)
+        self._worker.start()
+
+    @classmethod
+    def from_files(cls, model_path, class_json_path, **kwargs):
+        model, classes, _, groups = load_classifier(model_path, class_json_path)
+        return cls(model, classes, groups, **kwargs)
+
+    # --- PUBLIC API ---
+    def submit(self, image):
+        """Queue a PIL image and return a Future resolving to its decision dict."""
+        self._check_open()
+        future = Future()
+        # Preprocess on the caller's thread so decoding/resizing runs in parallel
+        try:
+            with span("preprocess"):
+                if self.tta == "off":
+                    resized, tensor = None, preprocess(image)
+                else:
+                    # Keep the uncropped image around for the TTA crops
+                    resized = preprocess_resized(image)
+                    tensor = center_crop(resized)
+        except Exception as e:
+            future.set_exception(e)
+            return future
+        with self._close_lock:
+            self._check_open()
+            self._queue.put((tensor, resized, future))
+        return future
+
+    def classify(self, image):
+        return self.submit(image).result()
+
+    def classify_many(self, images):
+        futures = [self.submit(image) for image in images]
+        return [f.result() for f in futures]
+
+    def tta_trigger_rate(self):
+        """Fraction of images that needed the TTA pass so far."""
+        return self.tta_triggered / self.tta_checked if self.tta_checked else 0.0
+
+    def close(self):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("VisionInferenceEngine is closed")
+
+    # --- WORKER LOOP ---
+    def _collect_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the shutdown marker back so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._collect_batch(first)
+            # Anything failing here fails this batch's futures, never the thread
+            try:
+                tensors = torch.stack([t for t, _, _ in batch])
+                VISION_BATCH_SIZE.observe(len(batch))
+                with span("vision_forward", batch_size=len(batch)):
+                    probs = predict_probs(self.model, tensors)
+                rows = self._tta_rows(probs)
+                if rows:
+                    with span("vision_tta", images=len(rows)):
+                        probs = average_tta(self.model, probs, [r for _, r, _ in batch], rows)
+                results = decide_batch(probs, self.classes, self.groups, tta_rows=set(rows))
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _tta_rows(self, probs):
+        if self.tta == "off":
+            return []
+        if self.tta == "always":
+            rows = list(range(len(probs)))
+        else:
+            rows = (decision_margins(probs, self.groups) < self.tta_margin).nonzero().flatten().tolist()
+        self.tta_checked += len(probs)
+        self.tta_triggered += len(rows)
+        VISION_TTA.inc(len(rows), result="triggered")
+        VISION_TTA.inc(len(probs) - len(rows), result="skipped")
+        return rows
@@ -0,0 +1,446 @@
+# --- OFFLINE KNOWLEDGE BASE INGESTION ---
+# Rebuilds the Chroma DB used by bmw.py on a plain Linux box (no Colab/Drive).
+# Replaces notebooks/bmw_database_creator.ipynb:
+#
+#   cd src
+#   python -m ingest --data-dir /data/bmw_rag_data --rebuild
+#
+# Sources are streamed from --data-dir:
+#   *.pdf          PyMuPDF text layer, OCR only for pages without one
+#   *.html / *.htm forum and manual page saves
+#   *.jsonl        Wikipedia dumps, one {"title", "text"} object per line
+#   wiki_NN(.bz2)  WikiExtractor --json output (text/AA/wiki_00, ...), same format
+# Chunks are embedded in large batches and written with bulk collection.add
+# calls, tagged with the car_model / source_type metadata generate_answer filters on.
+#
+# Runs are incremental: a manifest next to the DB (ingest_state.py) records the
+# sha256 of every source and the chunk ids it produced. Unchanged files are
+# skipped, changed files have their old chunks replaced, chunks of deleted
+# files are removed, and OCR'd pages are checkpointed so a crash resumes
+# mid-manual. Use --rebuild to start from scratch.
+import argparse
+import bz2
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from class_metadata import CHASSIS_CODES
+from ingest_state import IngestManifest, file_sha256
+
+current_folder = os.path.dirname(os.path.abspath(__file__))
+parent_folder = os.path.dirname(current_folder)
+
+DB_PATH = f"{parent_folder}/models/bmw_knowledge_db_rag_paddleocr"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# langchain_chroma's default collection - the one bmw.py opens
+COLLECTION_NAME = "langchain"
+
+# Same splitter settings as the notebook
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+EMBED_BATCH_SIZE = 512
+# Documents split + queued for embedding at a time, so a big dump file is never held whole
+DOC_BATCH_SIZE = 256
+
+# Pages with less text than this get OCR'd (also the notebook's noise filter)
+MIN_PAGE_CHARS = 20
+OCR_ZOOM = 2
+OCR_MAX_WIDTH = 2000
+
+# Shared with the UI's class table; order matters, "E36-7"/"E36-8" (Z3) must win over "E36"
+FOCUS_CARS = CHASSIS_CODES
+
+
+def get_matching_chassis(text):
+    if not text: return None
+    text = text.lower()
+    for code in FOCUS_CARS:
+        if code.lower() in text: return code
+    return None
+
+
+def chassis_for_path(path):
+    return get_matching_chassis(os.path.basename(path)) or get_matching_chassis(os.path.dirname(path)) or "General"
+
+
+# WikiExtractor's extensionless output files, optionally --compress'ed
+WIKIEXTRACTOR_FILE = re.compile(r"wiki_\d+(\.bz2)?")
+
+
+def iter_source_files(data_dir):
+    """Yield (path, kind) for every supported file under data_dir, in a stable order."""
+    for root, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        for name in sorted(files):
+            lower = name.lower()
+            path = os.path.join(root, name)
+            if lower.endswith(".pdf"):
+                yield path, "pdf"
+            elif lower.endswith((".html", ".htm")):
+                yield path, "html"
+            elif lower.endswith(".jsonl") or WIKIEXTRACTOR_FILE.fullmatch(name):
+                yield path, "wiki"
+
+
+# --- OCR ---
+class OcrEngine:
+    """PaddleOCR or Tesseract, imported lazily so text-only runs need neither.
+
+    This is the serial path; ocr_pool.OcrPool offers the same extract_pages
+    interface with a producer process and N OCR workers.
+    """
+
+    def __init__(self, backend="paddle"):
+        self.backend = backend
+        self._reader = None
+
+    def load(self):
+        if self.backend == "paddle":
+            from paddleocr import PaddleOCR
+            self._reader = PaddleOCR(use_angle_cls=True, lang='en', show_log=False)
+        elif self.backend == "tesseract":
+            import pytesseract
+            self._reader = pytesseract
+        elif self.backend != "none":
+            raise ValueError(f"Unknown OCR backend '{self.backend}'")
+
+    def read(self, img):
+        if self.backend == "none":
+            return ""
+        if self._reader is None:
+            self.load()
+        if self.backend == "tesseract":
+            return self._reader.image_to_string(img, config='--psm 3')
+        result = self._reader.ocr(img, cls=True)
+        if not result or not result[0]:
+            return ""
+        # Confidence threshold from the notebook
+        return " ".join(line[1][0] for line in result[0] if line[1][1] > 0.5)
+
+    def extract_pages(self, path, cached=None, on_ocr=None):
+        """Return {page_no: text}, OCR'ing only pages without a text layer and not in `cached`."""
+        import fitz
+
+        cached = cached or {}
+        pages = {}
+        with fitz.open(path) as pdf:
+            for i, page in enumerate(pdf):
+                page_no = i + 1
+                try:
+                    text = page.get_text().strip()
+                    if len(text) < MIN_PAGE_CHARS:
+                        # Scanned page - no usable text layer
+                        if page_no in cached:
+                            text = cached[page_no]
+                        else:
+                            text = self.read(render_page(page)).strip()
+                            if on_ocr is not None:
+                                on_ocr(page_no, text)
+                    pages[page_no] = text
+                except Exception as e:
+                    print(f"    Skipping page {page_no} in {os.path.basename(path)}: {str(e)[:50]}")
+        return pages
+
+
+def render_page(page, zoom=OCR_ZOOM, max_width=OCR_MAX_WIDTH):
+    """Render a PDF page to an RGB array, downscaled so huge scans stay cheap to OCR."""
+    import fitz
+    from PIL import Image
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    if img.width > max_width:
+        img = img.resize((max_width, int(img.height * max_width / img.width)), Image.LANCZOS)
+    return np.asarray(img)
+
+
+# --- LOADERS ---
+def load_pdf(path, ocr, manifest=None, content_hash=None):
+    """`ocr` is an OcrEngine or an OcrPool; OCR'd pages are checkpointed in the manifest."""
+    from langchain_core.documents import Document
+
+    cached, on_ocr = {}, None
+    if manifest:
+        cached = manifest.ocr_pages(content_hash)
+        on_ocr = lambda page_no, text: manifest.save_ocr_page(content_hash, page_no, text)
+    pages = ocr.extract_pages(path, cached, on_ocr)
+
+    metadata = {"car_model": chassis_for_path(path), "source_type": "Manual", "filename": os.path.basename(path), "source": path}
+    docs = []
+    for page_no in sorted(pages):
+        page_text = pages[page_no]
+        if len(page_text) > MIN_PAGE_CHARS:
+            docs.append(Document(page_content=f"[Page {page_no}] {page_text}", metadata={**metadata, "page": page_no}))
+    return docs
+
+
+def load_html(path):
+    from bs4 import BeautifulSoup
+    from langchain_core.documents import Document
+
+    try:
+        with open(path, 'r', encoding='utf-8') as f: content = f.read()
+    except UnicodeDecodeError:
+        with open(path, 'r', encoding='latin-1') as f: content = f.read()
+
+    soup = BeautifulSoup(content, 'html.parser')
+    for junk in soup(["script", "style", "nav", "footer", "header", "aside", "iframe"]):
+        junk.extract()
+
+    text = soup.get_text(separator=' ', strip=True)
+    if not text:
+        return []
+    return [Document(
+        page_content=text,
+        metadata={"source": path, "car_model": chassis_for_path(path), "source_type": "Manual HTML Save"}
+    )]
+
+
+def load_wikipedia_dump(path):
+    """Yields one Document per article, so a multi-GB dump file is never loaded whole."""
+    from langchain_core.documents import Document
+
+    opener = bz2.open if path.endswith(".bz2") else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            article = json.loads(line)
+            text = article.get("text", "").strip()
+            if not text:
+                continue
+            title = article.get("title", "")
+            yield Document(
+                page_content=text,
+                metadata={
+                    "source": article.get("url") or f"{path}#{title}",
+                    "title": title,
+                    "car_model": get_matching_chassis(title) or "General",
+                    "source_type": "General History"
+                }
+            )
+
+
+def load_documents(path, kind, ocr, manifest=None, content_hash=None):
+    if kind == "pdf":
+        return load_pdf(path, ocr, manifest, content_hash)
+    if kind == "html":
+        return load_html(path)
+    return load_wikipedia_dump(path)
+
+
+# --- CHUNK + EMBED + WRITE ---
+def chunk_id(chunk):
+    # Deterministic ids so re-running never duplicates a chunk
+    meta = chunk.metadata
+    key = f"{meta.get('source')}|{meta.get('page', '')}|{meta.get('chunk_index')}|{chunk.page_content}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class ChromaWriter:
+    """Buffers chunks and writes them with large embed batches and bulk adds.
+
+    `add(chunks, on_written)` calls `on_written()` once every chunk of that
+    call has actually been written, which is when a file may be checkpointed.
+    """
+
+    def __init__(self, db_path, embedding_model=EMBEDDING_MODEL, batch_size=EMBED_BATCH_SIZE, device="cpu"):
+        import chromadb
+        from langchain_huggingface import HuggingFaceEmbeddings
+
+        self.batch_size = batch_size
+        self.embeddings = HuggingFaceEmbeddings(
+            model_name=embedding_model,
+            model_kwargs={'device': device},
+            encode_kwargs={'batch_size': 128}
+        )
+        self.client = chromadb.PersistentClient(path=db_path)
+        self.collection = self.client.get_or_create_collection(COLLECTION_NAME)
+        self.max_add = self.client.get_max_batch_size()
+        self.written = 0
+        self._buffer = []
+        self._queued = 0
+        self._callbacks = []
+
+    def add(self, chunks, on_written=None):
+        self._buffer.extend(chunks)
+        self._queued += len(chunks)
+        if on_written is not None:
+            self._callbacks.append((self._queued, on_written))
+        while len(self._buffer) >= self.batch_size:
+            self._flush(self._buffer[:self.batch_size])
+            self._buffer = self._buffer[self.batch_size:]
+        self._notify()
+
+    def flush(self):
+        if self._buffer:
+            self._flush(self._buffer)
+            self._buffer = []
+        self._notify()
+
+    def delete(self, ids):
+        for start in range(0, len(ids), self.max_add):
+            self.collection.delete(ids=ids[start:start + self.max_add])
+
+    def _notify(self):
+        while self._callbacks and self._callbacks[0][0] <= self.written:
+            self._callbacks.pop(0)[1]()
+
+    def _flush(self, chunks):
+        texts = [c.page_content for c in chunks]
+        vectors = self.embeddings.embed_documents(texts)
+        ids = [chunk_id(c) for c in chunks]
+        metadatas = [c.metadata for c in chunks]
+        for start in range(0, len(chunks), self.max_add):
+            end = start + self.max_add
+            self.collection.upsert(
+                ids=ids[start:end], embeddings=vectors[start:end],
+                documents=texts[start:end], metadatas=metadatas[start:end]
+            )
+        self.written += len(chunks)
+
+
+def make_splitter():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+
+def iter_document_batches(path, kind, ocr, manifest=None, content_hash=None, size=DOC_BATCH_SIZE):
+    """Lists of up to `size` documents; loading starts (and may raise) on the first next()."""
+    batch = []
+    for doc in load_documents(path, kind, ocr, manifest, content_hash):
+        batch.append(doc)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def split_documents(splitter, docs):
+    chunks = splitter.split_documents(docs)
+    # chunk_index is per source (+ page), used for stable ids
+    counters = {}
+    for chunk in chunks:
+        key = (chunk.metadata.get("source"), chunk.metadata.get("page"))
+        chunk.metadata["chunk_index"] = counters.get(key, 0)
+        counters[key] = chunk.metadata["chunk_index"] + 1
+    return chunks
+
+
+def ingest(data_dir, db_path=DB_PATH, ocr_backend="paddle", rebuild=False, batch_size=EMBED_BATCH_SIZE, device="cpu",
+           ocr_workers=0, shards=False):
+    if not os.path.isdir(data_dir):
+        raise FileNotFoundError(f"Data directory not found: {data_dir}")
+    if rebuild and os.path.exists(db_path):
+        shutil.rmtree(db_path)
+        print("  Replaced old database")
+
+    if ocr_workers > 0 and ocr_backend != "none":
+        from ocr_pool import OcrPool
+        ocr = OcrPool(ocr_backend, workers=ocr_workers)
+    else:
+        ocr = OcrEngine(ocr_backend)
+    splitter = make_splitter()
+    writer = ChromaWriter(db_path, batch_size=batch_size, device=device)
+    manifest = IngestManifest(db_path)
+
+    start = time.time()
+    seen = set()
+    stats = {"new": 0, "changed": 0, "unchanged": 0, "removed": 0, "failed": 0}
+    for path, kind in iter_source_files(data_dir):
+        source = os.path.relpath(path, data_dir)
+        seen.add(source)
+        content_hash = file_sha256(path)
+        previous = manifest.get(source)
+        if previous and previous[0] == content_hash:
+            stats["unchanged"] += 1
+            continue
+
+        # Split and queue a batch of documents at a time; a file that fails halfway
+        # is not checkpointed, and its chunks are upserted again on the next run
+        ids, error = [], None
+        batches = iter_document_batches(path, kind, ocr, manifest, content_hash)
+        while True:
+            try:
+                docs = next(batches, None)
+            except Exception as e:
+                error = e
+                break
+            if docs is None:
+                break
+            chunks = split_documents(splitter, docs)
+            ids.extend(chunk_id(c) for c in chunks)
+            writer.add(chunks)
+        if error is not None:
+            print(f"  Failed to read {source}: {error}")
+            stats["failed"] += 1
+            continue
+
+        if previous:
+            # Drop chunks the new version no longer produces
+            stale = sorted(set(previous[1]) - set(ids))
+            writer.delete(stale)
+            stats["changed"] += 1
+        else:
+            stats["new"] += 1
+
+        # Checkpoint only once all of this file's chunks are in Chroma
+        writer.add([], on_written=lambda s=source, h=content_hash, i=ids: manifest.mark_done(s, h, i))
+        print(f"  {'Updated' if previous else 'Added'} {source} ({kind}, {len(ids)} chunks)")
+    writer.flush()
+
+    # Files that disappeared from the data directory
+    for source in manifest.sources():
+        if source not in seen:
+            writer.delete(manifest.get(source)[1])
+            manifest.remove(source)
+            stats["removed"] += 1
+            print(f"  Removed {source}")
+    manifest.close()
+
+    # Keep the BM25 keyword index in sync with the collection
+    from hybrid_search import BM25Index
+    from langchain_chroma import Chroma
+    db = Chroma(client=writer.client, collection_name=COLLECTION_NAME)
+    BM25Index.from_chroma(db).save(db_path)
+
+    # Per-chassis shards: built on request, and kept in sync once they exist
+    from sharded_index import SHARDS_DIR, build_shards
+    if shards or os.path.isdir(os.path.join(db_path, SHARDS_DIR)):
+        print(f"   Rebuilt {len(build_shards(db, db_path))} per-chassis shards")
+
+    if hasattr(ocr, "close"):
+        if ocr.pages:
+            print(f"   OCR stage: {ocr.pages} pages, {ocr.ocr_pages} OCR'd, {ocr.throughput():.1f} pages/sec")
+        ocr.close()
+
+    print(f"\n✅ DONE! {writer.written} chunks written in {time.time() - start:.0f}s -> {db_path}")
+    print("   " + ", ".join(f"{v} {k}" for k, v in stats.items()))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the BMW knowledge base from local PDFs, HTML and Wikipedia dumps.")
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--db-path", default=DB_PATH)
+    parser.add_argument("--ocr", choices=["paddle", "tesseract", "none"], default="paddle")
+    parser.add_argument("--ocr-workers", type=int, default=0,
+                        help="OCR worker processes (0 = OCR in the main process)")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunks per embedding batch")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--rebuild", action="store_true", help="Delete the existing DB and manifest first")
+    parser.add_argument("--shards", action="store_true", help="Also build one vector shard per car_model")
+    args = parser.parse_args()
+
+    ingest(args.data_dir, args.db_path, ocr_backend=args.ocr, rebuild=args.rebuild,
+           batch_size=args.batch_size, device=args.device, ocr_workers=args.ocr_workers, shards=args.shards)
+
+
+if __name__ == "__main__":
+    main()
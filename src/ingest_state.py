@@ -0,0 +1,85 @@
+# --- INGESTION MANIFEST ---
+# Per-document fingerprints and checkpoints for incremental knowledge base
+# updates. Lives next to the Chroma files so the DB and its manifest move together.
+#
+#   documents  source (relative path) -> file sha256 + the chunk ids it produced
+#   ocr_pages  (file sha256, page) -> OCR text, so a crash mid-manual resumes
+#              from the last OCR'd page instead of starting over
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+MANIFEST_NAME = "ingest_manifest.sqlite3"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    def __init__(self, db_path):
+        os.makedirs(db_path, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(db_path, MANIFEST_NAME))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                source TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                chunk_ids TEXT NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_pages (
+                content_hash TEXT NOT NULL,
+                page INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (content_hash, page)
+            )
+        """)
+        self._conn.commit()
+
+    # --- DOCUMENTS ---
+    def get(self, source):
+        """(content_hash, chunk_ids) of the last completed ingest of `source`, or None."""
+        row = self._conn.execute(
+            "SELECT content_hash, chunk_ids FROM documents WHERE source = ?", (source,)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def sources(self):
+        return [r[0] for r in self._conn.execute("SELECT source FROM documents")]
+
+    def mark_done(self, source, content_hash, chunk_ids):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+            (source, content_hash, json.dumps(chunk_ids), time.time())
+        )
+        # The document is fully written, its OCR checkpoint is no longer needed
+        self._conn.execute("DELETE FROM ocr_pages WHERE content_hash = ?", (content_hash,))
+        self._conn.commit()
+
+    def remove(self, source):
+        self._conn.execute("DELETE FROM documents WHERE source = ?", (source,))
+        self._conn.commit()
+
+    # --- OCR CHECKPOINT ---
+    def ocr_pages(self, content_hash):
+        """{page: text} of every page already OCR'd for this file version."""
+        rows = self._conn.execute(
+            "SELECT page, text FROM ocr_pages WHERE content_hash = ?", (content_hash,)
+        ).fetchall()
+        return dict(rows)
+
+    def save_ocr_page(self, content_hash, page, text):
+        self._conn.execute("INSERT OR REPLACE INTO ocr_pages VALUES (?, ?, ?)", (content_hash, page, text))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,346 @@
+# --- GEMINI CLIENT LAYER ---
+# Long-lived async client for answer generation:
+#   * one pooled `prompt | llm` chain per API key (built once, not per call)
+#   * a token bucket per API key sized to the gemini-2.5-flash-lite quota
+#   * jittered exponential backoff on ResourceExhausted, awaited not slept
+#   * identical in-flight prompts with the same API key share a single request
+#     (streamed ones too: later callers replay the first caller's stream)
+# Sync callers (the Streamlit script) go through `invoke` / `stream`, which run
+# the coroutine on a background event loop instead of sleeping their own thread.
+import asyncio
+import hashlib
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from google.api_core.exceptions import ResourceExhausted
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from metrics import GEMINI_BACKOFF_SECONDS, GEMINI_REQUESTS, GEMINI_RETRIES, STAGE_SECONDS, span
+
+GEMINI_MODEL = "gemini-2.5-flash-lite"
+# Free-tier quota for gemini-2.5-flash-lite, per API key
+GEMINI_REQUESTS_PER_MINUTE = 15
+
+TRAFFIC_LIMIT_MESSAGE = "⚠️ **Traffic Limit Reached:** The AI is currently overwhelmed (Quota Limit). Please wait 60 seconds and try again."
+CANCELLED_MESSAGE = "⚠️ **AI Error:** The request was cancelled. Please try again."
+
+ANSWER_PROMPT = ChatPromptTemplate.from_template("""
+    You are a professional and objective BMW mechanic information assistant. Your tone must be human-like, direct, technical, and strictly focused on providing procedural or technical information.
+
+    Context from Expert Guides/Forums:
+    {context}
+
+    The user has identified their car as a: {car_model}
+    User Question: {question}
+
+    Instructions:
+    1.  **Primary Rule:** Answer the user's question based strictly on the technical and procedural information found within the provided context.
+    2.  **Anecdotal/Narrative Filtering:** **Crucially, ignore and omit all personal, anecdotal, or non-technical details (e.g., mentions of specific people, purchase stories, personal opinions, car histories, or project timelines) from the context.** Focus only on facts, steps, parts, and technical specifications.
+    3.  **Handling Mentioned Procedures:** If the context mentions a specific procedure or modification (like a "Euro bumper swap") but **does not** provide the detailed technical steps, summarize the finding by stating that information *about the existence and availability of this modification* is present in enthusiast discussions, but the step-by-step instructions are not detailed in the provided materials. **Do not mention any specific person by name.**
+    4.  **General Knowledge Fallback:** If the answer requires information not available in the context (after filtering), you must clearly state: "The detailed technical steps are not available in the provided materials."
+    5.  **Model Fallback:** If the user's car model is NOT in the context, strictly state: "I couldn't find detailed information for this specific model in my database, but here is general information based on standard automotive knowledge:" and then provide a helpful answer based on general knowledge.
+    """)
+
+
+def _key_id(api_key):
+    # Pool entries are keyed by a digest so raw keys never become dict keys or log lines
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _request_key(car_model, question, context_text, api_key):
+    # temperature=0, so identical prompts give identical answers; the key is part of it
+    # so one user's quota or auth error is never handed to another
+    return hashlib.sha256("\x00".join([_key_id(api_key), car_model, question, context_text]).encode()).hexdigest()
+
+
+class _SharedStream:
+    """Pieces of one in-flight streamed answer, replayed to every caller of the same request."""
+
+    def __init__(self):
+        self.pieces = []
+        self.done = False
+        self.succeeded = False
+        self._changed = asyncio.Event()
+
+    def publish(self, piece):
+        self.pieces.append(piece)
+        self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        # A fresh event per change, so no follower can miss one between wait and clear
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self):
+        sent = 0
+        while True:
+            while sent < len(self.pieces):
+                yield self.pieces[sent]
+                sent += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class TokenBucket:
+    """Thread-safe token bucket usable from any event loop."""
+
+    def __init__(self, requests_per_minute, burst=None):
+        self.interval = 60.0 / requests_per_minute
+        self.capacity = burst or requests_per_minute
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait=None):
+        """Take a token; return seconds until it is usable, or None if that exceeds max_wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) / self.interval)
+            self._updated = now
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) * self.interval
+            if max_wait is not None and wait > max_wait:
+                return None
+            # Tokens may go negative: later callers queue up behind this reservation
+            self._tokens -= 1
+            return wait
+
+    def drain(self):
+        """Called after a quota error so every queued caller backs off together."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0)
+            self._updated = time.monotonic()
+
+    async def acquire(self, max_wait=None):
+        wait = self.reserve(max_wait)
+        if wait is None:
+            return False
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return True
+
+
+class GeminiClient:
+    def __init__(self, requests_per_minute=GEMINI_REQUESTS_PER_MINUTE, max_retries=3,
+                 backoff_base=2.0, max_queue_wait=20.0):
+        self.requests_per_minute = requests_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        # One budget for all waiting in a call: token-bucket queueing plus retry backoff
+        self.max_queue_wait = max_queue_wait
+
+        self._chains = {}
+        self._buckets = {}
+        self._inflight = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+        # Background loop for sync callers
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="gemini-client", daemon=True).start()
+
+    # --- POOLS ---
+    def chain(self, api_key):
+        key_id = _key_id(api_key)
+        with self._lock:
+            if key_id not in self._chains:
+                llm = ChatGoogleGenerativeAI(
+                    model=GEMINI_MODEL,
+                    temperature=0,
+                    google_api_key=api_key,
+                    convert_system_message_to_human=True,
+                    max_retries=1
+                )
+                self._chains[key_id] = ANSWER_PROMPT | llm
+            return self._chains[key_id]
+
+    def bucket(self, api_key):
+        key_id = _key_id(api_key)
+        with self._lock:
+            if key_id not in self._buckets:
+                self._buckets[key_id] = TokenBucket(self.requests_per_minute)
+            return self._buckets[key_id]
+
+    # --- PUBLIC API ---
+    async def ainvoke(self, car_model, question, context_text, api_key):
+        """Answer text, or a user-facing ⚠️ message on failure. Never raises."""
+        request_key = _request_key(car_model, question, context_text, api_key)
+        with self._lock:
+            pending = self._inflight.get(request_key)
+            owner = pending is None
+            if owner:
+                pending = Future()
+                self._inflight[request_key] = pending
+
+        if not owner:
+            GEMINI_REQUESTS.inc(outcome="deduplicated")
+            return await asyncio.wrap_future(pending)
+
+        # What deduplicated waiters get if a BaseException (e.g. cancellation) ends this call
+        answer = CANCELLED_MESSAGE
+        try:
+            answer = await self._call_with_backoff(car_model, question, context_text, api_key)
+        except Exception as e:
+            GEMINI_REQUESTS.inc(outcome="error")
+            answer = f"⚠️ **AI Error:** {str(e)}"
+        finally:
+            with self._lock:
+                self._inflight.pop(request_key, None)
+            pending.set_result(answer)
+        return answer
+
+    def invoke(self, car_model, question, context_text, api_key):
+        """Blocking wrapper that waits on the background loop, not on time.sleep."""
+        future = asyncio.run_coroutine_threadsafe(
+            self.ainvoke(car_model, question, context_text, api_key), self._loop
+        )
+        return future.result()
+
+    async def astream(self, car_model, question, context_text, api_key, on_complete=None):
+        """Yield answer text as it is generated; `on_complete(full_text)` runs only on success."""
+        request_key = _request_key(car_model, question, context_text, api_key)
+        with self._lock:
+            shared = self._streams.get(request_key)
+            owner = shared is None
+            if owner:
+                shared = _SharedStream()
+                self._streams[request_key] = shared
+
+        if not owner:
+            GEMINI_REQUESTS.inc(outcome="deduplicated")
+            async for piece in shared.follow():
+                yield piece
+            if shared.succeeded and on_complete is not None:
+                on_complete("".join(shared.pieces))
+            return
+
+        def completed(text):
+            shared.succeeded = True
+            if on_complete is not None:
+                on_complete(text)
+
+        try:
+            async for piece in self._stream_with_backoff(car_model, question, context_text, api_key, completed):
+                shared.publish(piece)
+                yield piece
+        except Exception as e:
+            # The caller's stream() reports it; followers get it as text
+            shared.publish(f"⚠️ **AI Error:** {str(e)}")
+            raise
+        finally:
+            with self._lock:
+                self._streams.pop(request_key, None)
+            shared.finish()
+
+    def stream(self, car_model, question, context_text, api_key, on_complete=None):
+        """Sync generator over `astream`, e.g. for st.write_stream."""
+        pieces = queue.Queue()
+
+        async def pump():
+            try:
+                async for piece in self.astream(car_model, question, context_text, api_key, on_complete):
+                    pieces.put(piece)
+            except Exception as e:
+                pieces.put(f"⚠️ **AI Error:** {str(e)}")
+            finally:
+                pieces.put(None)
+
+        asyncio.run_coroutine_threadsafe(pump(), self._loop)
+        while True:
+            piece = pieces.get()
+            if piece is None:
+                return
+            yield piece
+
+    # --- INTERNALS ---
+    async def _stream_with_backoff(self, car_model, question, context_text, api_key, on_complete):
+        chain = self.chain(api_key)
+        bucket = self.bucket(api_key)
+        inputs = {"context": context_text, "car_model": car_model, "question": question}
+        deadline = time.monotonic() + self.max_queue_wait
+
+        for attempt in range(self.max_retries):
+            with span("gemini_queue"):
+                acquired = await bucket.acquire(max_wait=max(0.0, deadline - time.monotonic()))
+            if not acquired:
+                GEMINI_REQUESTS.inc(outcome="rate_limited")
+                yield TRAFFIC_LIMIT_MESSAGE
+                return
+            pieces = []
+            start = time.perf_counter()
+            try:
+                async for chunk in chain.astream(inputs):
+                    if chunk.content:
+                        if not pieces:
+                            STAGE_SECONDS.observe(time.perf_counter() - start, stage="gemini_first_token")
+                        pieces.append(chunk.content)
+                        yield chunk.content
+            except ResourceExhausted:
+                bucket.drain()
+                if pieces:
+                    # Tokens already reached the user; a retry would repeat them
+                    GEMINI_REQUESTS.inc(outcome="rate_limited")
+                    yield "\n\n" + TRAFFIC_LIMIT_MESSAGE
+                    return
+                if not await self._backoff(attempt, deadline):
+                    break
+                continue
+            except Exception as e:
+                GEMINI_REQUESTS.inc(outcome="error")
+                yield f"\n\n⚠️ **AI Error:** {str(e)}" if pieces else f"⚠️ **AI Error:** {str(e)}"
+                return
+
+            STAGE_SECONDS.observe(time.perf_counter() - start, stage="gemini_call")
+            GEMINI_REQUESTS.inc(outcome="ok")
+            if on_complete is not None:
+                on_complete("".join(pieces))
+            return
+
+        GEMINI_REQUESTS.inc(outcome="rate_limited")
+        yield TRAFFIC_LIMIT_MESSAGE
+
+    async def _call_with_backoff(self, car_model, question, context_text, api_key):
+        chain = self.chain(api_key)
+        bucket = self.bucket(api_key)
+        inputs = {"context": context_text, "car_model": car_model, "question": question}
+        # Fail fast instead of parking the caller for a whole quota window
+        deadline = time.monotonic() + self.max_queue_wait
+
+        for attempt in range(self.max_retries):
+            with span("gemini_queue"):
+                acquired = await bucket.acquire(max_wait=max(0.0, deadline - time.monotonic()))
+            if not acquired:
+                GEMINI_REQUESTS.inc(outcome="rate_limited")
+                return TRAFFIC_LIMIT_MESSAGE
+            try:
+                with span("gemini_call", attempt=attempt):
+                    response = await chain.ainvoke(inputs)
+                GEMINI_REQUESTS.inc(outcome="ok")
+                return response.content
+            except ResourceExhausted:
+                bucket.drain()
+                if not await self._backoff(attempt, deadline):
+                    break
+
+        GEMINI_REQUESTS.inc(outcome="rate_limited")
+        return TRAFFIC_LIMIT_MESSAGE
+
+    async def _backoff(self, attempt, deadline):
+        """Sleep before the next attempt; False, without sleeping, if there is none to wait for."""
+        if attempt + 1 >= self.max_retries:
+            return False
+        delay = self.backoff_base * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if time.monotonic() + delay > deadline:
+            return False
+        GEMINI_RETRIES.inc()
+        GEMINI_BACKOFF_SECONDS.inc(delay)
+        await asyncio.sleep(delay)
+        return True
@@ -0,0 +1,203 @@
+# --- PIPELINE METRICS ---
+# Latency spans per stage (decode -> preprocess -> vision forward, embed ->
+# search -> context -> generate), cache hit/miss counters (predictions,
+# embeddings, answers), retrieval strategy
+# counters, context token counters and Gemini retry/backoff counters, kept in-process and rendered in
+# the Prometheus text format (service.py serves them on /metrics, the
+# Streamlit app on BMW_METRICS_PORT).
+#
+# BMW_METRICS=0 turns every call below into an early return.
+# BMW_METRICS_LOG=1 also writes one JSON log line per span.
+import json
+import logging
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("BMW_METRICS", "1") != "0"
+LOG_SPANS = ENABLED and os.environ.get("BMW_METRICS_LOG", "0") == "1"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger("bmwchat.metrics")
+if LOG_SPANS and not logger.handlers:
+    # One JSON object per line on stderr, ready for a log shipper
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+_registry = []
+
+
+def _label_key(labelnames, labels):
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames, key, extra=()):
+    pairs = [f'{n}="{v}"' for n, v in zip(labelnames, key)] + [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(self.labelnames, labels), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {}  # key -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        if not ENABLED:
+            return
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, row):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {row[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {row[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {row[-1]}")
+        return lines
+
+
+# --- THE METRICS ---
+STAGE_SECONDS = Histogram("bmw_stage_seconds", "Latency of each pipeline stage", ("stage",))
+VISION_BATCH_SIZE = Histogram("bmw_vision_batch_size", "Images per B4 forward pass", (),
+                              buckets=(1, 2, 4, 8, 16, 32))
+EMBED_BATCH_SIZE = Histogram("bmw_embed_batch_size", "Questions per MiniLM forward pass", (),
+                             buckets=(1, 2, 4, 8, 16, 32))
+VISION_TTA = Counter("bmw_vision_tta_total", "Images by whether the test-time augmentation pass ran", ("result",))
+CACHE_REQUESTS = Counter("bmw_cache_requests_total", "Cache lookups", ("cache", "result"))
+RETRIEVAL_STRATEGY = Counter("bmw_retrieval_strategy_total", "Retrievals answered by each strategy", ("strategy",))
+CONTEXT_CHUNKS = Counter("bmw_context_chunks_total", "Retrieved chunks before (in) and after (out) context building", ("kind",))
+CONTEXT_TOKENS = Counter("bmw_context_tokens_total", "Estimated context tokens in, out and saved by context building", ("kind",))
+GEMINI_REQUESTS = Counter("bmw_gemini_requests_total", "Gemini calls by outcome", ("outcome",))
+GEMINI_RETRIES = Counter("bmw_gemini_retries_total", "Gemini retries after a 429")
+GEMINI_BACKOFF_SECONDS = Counter("bmw_gemini_backoff_seconds_total", "Time spent sleeping in Gemini backoff")
+
+
+# --- SPANS ---
+class _Span:
+    __slots__ = ("stage", "fields", "start")
+
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, stage=self.stage)
+        if LOG_SPANS:
+            record = {"ts": round(time.time(), 3), "event": "span", "stage": self.stage,
+                      "ms": round(elapsed * 1000, 2), **self.fields}
+            if exc_type is not None:
+                record["error"] = exc_type.__name__
+            logger.info(json.dumps(record, default=str))
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(stage, **fields):
+    """`with span("embed"):` times the block into bmw_stage_seconds{stage="embed"}."""
+    if not ENABLED:
+        return _NO_SPAN
+    return _Span(stage, fields)
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+
+# --- EXPORT ---
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+_server = None
+
+
+def start_http_server(port, host="0.0.0.0"):
+    """Serve render() on http://host:port/metrics from a daemon thread (once per process)."""
+    global _server
+    if _server is not None or not ENABLED:
+        return _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200 if self.path.startswith("/metrics") else 404)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    _server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=_server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{port}/metrics")
+    return _server
@@ -0,0 +1,186 @@
+# --- PARALLEL OCR WORKER POOL ---
+# Multiprocess OCR stage for ingest.py:
+#   producer process  opens the PDF, passes text-layer pages straight through
+#                     and renders scanned pages into a bounded task queue
+#   N worker procs    each preload their own OCR engine once and OCR pages
+#   main process      collects results (and checkpoints them) as they arrive
+# The bounded queue keeps at most a few rendered pages in memory, so a
+# 1000-page manual costs the same RAM as a 10-page one.
+#
+# A producer or worker that dies hard (segfault, OOM kill) fails that PDF
+# with OcrProcessDied instead of hanging ingest; dead processes are replaced.
+import multiprocessing as mp
+import os
+import queue
+import time
+
+from ingest import MIN_PAGE_CHARS, OcrEngine, render_page
+
+_STOP = None
+RESULT_POLL_SECONDS = 5.0
+
+
+class OcrProcessDied(RuntimeError):
+    pass
+
+
+def _ocr_worker(backend, tasks, results):
+    engine = OcrEngine(backend)
+    engine.load()  # preload before the first page arrives
+    while True:
+        task = tasks.get()
+        if task is _STOP:
+            break
+        job_id, page_no, img = task
+        try:
+            text = engine.read(img).strip()
+        except Exception as e:
+            # Not checkpointed, so a resumed run tries the page again (as in the serial path)
+            results.put(("error", job_id, page_no, str(e)))
+            continue
+        results.put(("ocr", job_id, page_no, text))
+
+
+def _page_producer(job_id, path, skip_pages, tasks, results):
+    import fitz
+
+    scanned = 0
+    try:
+        with fitz.open(path) as pdf:
+            for i, page in enumerate(pdf):
+                page_no = i + 1
+                try:
+                    text = page.get_text().strip()
+                    if len(text) >= MIN_PAGE_CHARS:
+                        # Text layer present - no OCR needed
+                        results.put(("text", job_id, page_no, text))
+                    elif page_no not in skip_pages:
+                        tasks.put((job_id, page_no, render_page(page)))  # blocks when the queue is full
+                        scanned += 1
+                except Exception as e:
+                    print(f"    Skipping page {page_no}: {str(e)[:50]}")
+    finally:
+        results.put(("done", job_id, scanned, None))
+
+
+class OcrPool:
+    """Long-lived pool; engines stay loaded across PDFs."""
+
+    def __init__(self, backend="paddle", workers=2, queue_size=None):
+        self.backend = backend
+        self.workers = workers
+        # spawn: OCR runtimes (Paddle especially) do not survive fork reliably
+        self._ctx = mp.get_context("spawn")
+        self._queue_size = queue_size or workers * 2
+        self._start_queues()
+        self._job_id = 0
+
+        self.pages = 0
+        self.ocr_pages = 0
+        self.seconds = 0.0
+
+    def extract_pages(self, path, cached=None, on_ocr=None):
+        """Return {page_no: text} for a PDF; `on_ocr(page_no, text)` fires per freshly OCR'd page.
+
+        Pages present in `cached` (page_no -> text) are not rendered or OCR'd again.
+        """
+        cached = cached or {}
+        self._job_id += 1
+        job_id = self._job_id
+        start = time.perf_counter()
+
+        producer = self._ctx.Process(
+            target=_page_producer, args=(job_id, path, set(cached), self._tasks, self._results), daemon=True
+        )
+        producer.start()
+
+        pages = {}
+        expected_ocr = None
+        received_ocr = 0
+        suspect = False
+        while expected_ocr is None or received_ocr < expected_ocr:
+            try:
+                kind, result_job, page_no, text = self._results.get(timeout=RESULT_POLL_SECONDS)
+            except queue.Empty:
+                dead = self._dead_processes(producer if expected_ocr is None else None)
+                # A process may have posted its last message just before exiting: only
+                # give up when it is still missing one poll after the death was seen
+                if dead and suspect:
+                    self._recover(producer, dead)
+                    raise OcrProcessDied(f"{', '.join(dead)} died while processing {os.path.basename(path)}")
+                suspect = bool(dead)
+                continue
+            if result_job != job_id:
+                continue
+            if kind == "done":
+                expected_ocr = page_no  # producer reports how many pages it queued
+            elif kind == "ocr":
+                received_ocr += 1
+                pages[page_no] = text
+                if on_ocr is not None:
+                    on_ocr(page_no, text)
+            elif kind == "error":
+                received_ocr += 1
+                print(f"    Skipping page {page_no} in {os.path.basename(path)}: {text[:50]}")
+            else:
+                pages[page_no] = text
+        producer.join()
+
+        for page_no, text in cached.items():
+            pages.setdefault(page_no, text)
+
+        elapsed = time.perf_counter() - start
+        self.pages += len(pages)
+        self.ocr_pages += received_ocr
+        self.seconds += elapsed
+        print(f"    OCR: {received_ocr} scanned / {len(pages)} pages in {elapsed:.1f}s "
+              f"({len(pages) / elapsed if elapsed else 0:.1f} pages/sec)")
+        return pages
+
+    # --- PROCESS MANAGEMENT ---
+    def _start_worker(self):
+        proc = self._ctx.Process(target=_ocr_worker, args=(self.backend, self._tasks, self._results), daemon=True)
+        proc.start()
+        return proc
+
+    def _start_queues(self):
+        self._tasks = self._ctx.Queue(maxsize=self._queue_size)
+        self._results = self._ctx.Queue()
+        self._procs = [self._start_worker() for _ in range(self.workers)]
+
+    def _dead_processes(self, producer=None):
+        dead = [f"OCR worker {i}" for i, proc in enumerate(self._procs) if not proc.is_alive()]
+        if producer is not None and not producer.is_alive():
+            dead.append("page producer")
+        return dead
+
+    def _recover(self, producer, dead):
+        """Abandon the current job; its leftover results are ignored by job id."""
+        if "page producer" in dead:
+            # It may have died halfway through writing a page into the task queue,
+            # so neither queue can be trusted: start over with fresh ones
+            for proc in self._procs:
+                proc.terminate()
+                proc.join()
+            self._start_queues()
+            return
+        # Workers only: replace them; the producer finishes queueing into the survivors
+        for i, proc in enumerate(self._procs):
+            if not proc.is_alive():
+                proc.join()
+                self._procs[i] = self._start_worker()
+
+    def throughput(self):
+        return self.pages / self.seconds if self.seconds else 0.0
+
+    def close(self):
+        for _ in self._procs:
+            self._tasks.put(_STOP)
+        for proc in self._procs:
+            proc.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,431 @@
+# --- BMWCHAT PIPELINE ---
+# Everything between "bytes of a photo / a question" and "prediction / answer",
+# with no Streamlit dependency. One Pipeline per process holds the vision
+# model, the embedding model, Chroma and the caches; every thread (Streamlit
+# sessions, HTTP request handlers) shares it.
+#
+# Used in-process by bmw.py, and behind HTTP by service.py.
+import hashlib
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from PIL import Image, UnidentifiedImageError
+
+import image_io
+from class_metadata import ClassTable, extract_chassis_code
+from prediction_cache import PredictionCache, file_fingerprint
+from answer_cache import SemanticAnswerCache
+from retrieval import RetrievalStage
+from hybrid_search import BM25Index, HybridSearcher
+from sharded_index import ShardRouter
+from context_builder import build_context
+from warmup import BackgroundLoader
+from metrics import CONTEXT_CHUNKS, CONTEXT_TOKENS, RETRIEVAL_STRATEGY, span
+from workers import configure_worker
+
+# torch, langchain and google.genai are imported lazily (inside the builders
+# below) so importing this module stays cheap.
+
+current_folder = os.path.dirname(os.path.abspath(__file__))
+parent_folder = os.path.dirname(current_folder)
+
+# --- CONFIGURATION ---
+MODEL_PATH = f"{parent_folder}/models/bmw_model_b4_noncar.pth"
+CLASS_JSON_PATH = f"{parent_folder}/models/bmw_class_map_b4.json"
+DB_PATH = f"{parent_folder}/models/bmw_knowledge_db_rag_paddleocr"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+# Question embedding (embedding_service.py): torch | onnx | onnx_int8.
+# Run `python -m embedding_service --export <dir>` before switching to ONNX.
+EMBED_BACKEND = os.environ.get("BMW_EMBED_BACKEND", "torch")
+EMBED_ONNX_DIR = os.environ.get("BMW_EMBED_ONNX_DIR", f"{parent_folder}/models/minilm_onnx")
+EMBED_THREADS = int(os.environ.get("BMW_EMBED_THREADS", 0))
+EMBED_MAX_BATCH_SIZE = int(os.environ.get("BMW_EMBED_MAX_BATCH", 16))
+EMBED_MAX_WAIT_MS = float(os.environ.get("BMW_EMBED_MAX_WAIT_MS", 5))
+EMBED_CACHE_ENTRIES = int(os.environ.get("BMW_EMBED_CACHE_ENTRIES", 4096))
+# float16 vectors in a memory-mapped file under BMW_CACHE_DIR (0 = off)
+EMBED_DISK_CACHE_ENTRIES = int(os.environ.get("BMW_EMBED_DISK_CACHE_ENTRIES", 32768))
+RETRIEVAL_K = int(os.environ.get("BMW_RETRIEVAL_K", 8))
+# Hybrid BM25 + vector search is used whenever the BM25 index exists next to the DB
+# (build it with `python -m hybrid_search`). Set BMW_HYBRID_SEARCH=0 to disable.
+HYBRID_SEARCH = os.environ.get("BMW_HYBRID_SEARCH", "1") != "0"
+HYBRID_CANDIDATES = int(os.environ.get("BMW_HYBRID_CANDIDATES", 20))
+# Optional CPU cross-encoder, e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANKER_MODEL = os.environ.get("BMW_RERANKER_MODEL")
+RETRIEVAL_BUDGET_MS = float(os.environ.get("BMW_RETRIEVAL_BUDGET_MS", 300))
+# Per-chassis vector shards are used whenever <DB>/shards exists
+# (build them with `python -m sharded_index`). Set BMW_SHARDED_INDEX=0 to disable.
+SHARDED_INDEX = os.environ.get("BMW_SHARDED_INDEX", "1") != "0"
+MAX_OPEN_SHARDS = int(os.environ.get("BMW_MAX_OPEN_SHARDS", 6))
+# Approximate prompt tokens allowed for retrieved context
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("BMW_CONTEXT_TOKEN_BUDGET", 2000))
+# Requests per minute allowed per API key (gemini-2.5-flash-lite free tier is 15)
+GEMINI_REQUESTS_PER_MINUTE = int(os.environ.get("BMW_GEMINI_RPM", 15))
+VISION_MAX_BATCH_SIZE = int(os.environ.get("BMW_VISION_MAX_BATCH", 8))
+VISION_MAX_WAIT_MS = float(os.environ.get("BMW_VISION_MAX_WAIT_MS", 10))
+# fp32 | dynamic_int8 | static_int8 | bf16 | compile | torchscript | onnx
+# Run `python -m vision_backends --images <held-out folder>` before switching.
+VISION_BACKEND = os.environ.get("BMW_VISION_BACKEND", "fp32")
+VISION_BACKEND_ARTIFACT = os.environ.get("BMW_VISION_ARTIFACT")
+VISION_CALIBRATION_DIR = os.environ.get("BMW_VISION_CALIBRATION_DIR")
+# Test-time augmentation: off | adaptive (only images whose decision margin is
+# below BMW_VISION_TTA_MARGIN get the extra flipped / shifted crops) | always
+VISION_TTA = os.environ.get("BMW_VISION_TTA", "off")
+VISION_TTA_MARGIN = float(os.environ.get("BMW_VISION_TTA_MARGIN", 0.15))
+# torch intra-op threads for this process (0 = torch default, i.e. all cores,
+# or this worker's share of them when BMW_WORKERS pins workers).
+TORCH_THREADS = int(os.environ.get("BMW_TORCH_THREADS", 0))
+# Worker processes per host (uvicorn --workers). Above 1, each worker is pinned
+# to cores / BMW_WORKERS cores and runs that many threads (workers.py).
+WORKERS = int(os.environ.get("BMW_WORKERS", 1))
+# Memory-map the B4 and MiniLM weights so all workers on a host share one copy
+SHARED_WEIGHTS = os.environ.get("BMW_SHARED_WEIGHTS", "0") == "1"
+# Render the UI first and load the vision model / RAG stack in background threads.
+# Set BMW_FAST_START=0 to load everything before the page appears.
+FAST_START = os.environ.get("BMW_FAST_START", "1") != "0"
+# Run a dummy forward pass and a dummy embedding after loading, so the first
+# real request doesn't pay JIT / allocator warm-up costs
+PREWARM = os.environ.get("BMW_PREWARM", "1") != "0"
+# Uploads that would still decode to more than this are rejected (JPEGs are
+# decoded at 1/2-1/8 scale first, so this mostly limits PNG / WebP)
+MAX_DECODE_MEGAPIXELS = float(os.environ.get("BMW_MAX_DECODE_MEGAPIXELS", 40))
+# Threads decoding the images of one classify_batch call (PIL releases the GIL)
+DECODE_THREADS = int(os.environ.get("BMW_DECODE_THREADS", 4))
+CACHE_DIR = os.environ.get("BMW_CACHE_DIR", f"{parent_folder}/.cache")
+PREDICTION_CACHE_MAX_ENTRIES = int(os.environ.get("BMW_PREDICTION_CACHE_MAX_ENTRIES", 50000))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("BMW_ANSWER_CACHE_THRESHOLD", 0.92))
+ANSWER_CACHE_TTL_HOURS = float(os.environ.get("BMW_ANSWER_CACHE_TTL_HOURS", 168))
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("BMW_ANSWER_CACHE_MAX_ENTRIES", 5000))
+
+STARTUP_LABELS = {"vision": "Identification model", "rag": "Repair manual database"}
+
+
+# --- STEP 1: LOAD THE VISION MODEL ---
+# Runs on a warm-up thread
+def build_vision_stack(threads=0):
+    import torch
+    from vision import IMAGE_SIZE
+    from vision_backends import load_backend_classifier
+    from inference_engine import VisionInferenceEngine
+
+    threads = TORCH_THREADS or threads
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+    # Class group masks are computed once here, not on every prediction
+    model, classes, idx_to_class, class_groups = load_backend_classifier(
+        VISION_BACKEND, MODEL_PATH, CLASS_JSON_PATH,
+        artifact_path=VISION_BACKEND_ARTIFACT,
+        calibration_dir=VISION_CALIBRATION_DIR,
+        shared_weights=SHARED_WEIGHTS
+    )
+    # Shared by every caller so concurrent uploads are batched together
+    engine = VisionInferenceEngine(
+        model, classes, class_groups,
+        max_batch_size=VISION_MAX_BATCH_SIZE,
+        max_wait_ms=VISION_MAX_WAIT_MS,
+        tta=VISION_TTA,
+        tta_margin=VISION_TTA_MARGIN
+    )
+    if PREWARM:
+        engine.classify(Image.new('RGB', (IMAGE_SIZE, IMAGE_SIZE)))
+    return model, classes, idx_to_class, class_groups, engine
+
+# Process-wide + on-disk cache of predictions, keyed by image hash
+# Layout of the decision dicts (vision.decide_batch); bump when fields change
+RESULT_FORMAT = 3
+
+def build_prediction_cache():
+    # Backend, decode path and TTA mode are part of the fingerprint since all of them shift scores
+    tta = f"{VISION_TTA}@{VISION_TTA_MARGIN}" if VISION_TTA == "adaptive" else VISION_TTA
+    fingerprint = file_fingerprint(
+        MODEL_PATH, CLASS_JSON_PATH,
+        extra=f"{VISION_BACKEND}:{image_io.DECODE_VERSION}:{tta}:r{RESULT_FORMAT}"
+    )
+    return PredictionCache(
+        os.path.join(CACHE_DIR, "predictions.sqlite3"),
+        fingerprint,
+        max_entries=PREDICTION_CACHE_MAX_ENTRIES
+    )
+
+
+# --- STEP 2: LOAD THE RAG BRAIN ---
+# Cached + micro-batched question embeddings, shared by retrieval and the answer cache
+def build_query_embedder(threads=0):
+    from embedding_service import QueryEmbedder, VectorCache, build_backend
+
+    shared_weights_path = os.path.join(CACHE_DIR, "shared_weights", f"{EMBEDDING_MODEL}.pt") if SHARED_WEIGHTS else None
+    backend = build_backend(
+        EMBED_BACKEND, EMBEDDING_MODEL,
+        onnx_dir=EMBED_ONNX_DIR,
+        num_threads=EMBED_THREADS or threads,
+        shared_weights_path=shared_weights_path
+    )
+    vector_cache = None
+    if EMBED_DISK_CACHE_ENTRIES:
+        os.makedirs(os.path.join(CACHE_DIR, "query_vectors"), exist_ok=True)
+        # Vectors from different backends differ slightly, so each gets its own file
+        vector_cache = VectorCache(
+            os.path.join(CACHE_DIR, "query_vectors", f"{EMBEDDING_MODEL}-{EMBED_BACKEND}"),
+            capacity=EMBED_DISK_CACHE_ENTRIES
+        )
+    return QueryEmbedder(
+        backend,
+        cache_entries=EMBED_CACHE_ENTRIES,
+        vector_cache=vector_cache,
+        max_batch_size=EMBED_MAX_BATCH_SIZE,
+        max_wait_ms=EMBED_MAX_WAIT_MS
+    )
+
+# Runs on a warm-up thread
+def build_rag_stack(threads=0):
+    from langchain_chroma import Chroma
+
+    db = Chroma(persist_directory=DB_PATH, embedding_function=build_query_embedder(threads))
+    hybrid = None
+    bm25 = BM25Index.load(DB_PATH) if HYBRID_SEARCH else None
+    if bm25 is not None:
+        hybrid = HybridSearcher(
+            db, bm25,
+            candidates=HYBRID_CANDIDATES,
+            reranker_model=RERANKER_MODEL,
+            budget_ms=RETRIEVAL_BUDGET_MS
+        )
+    shards = ShardRouter.load(DB_PATH, max_open=MAX_OPEN_SHARDS) if SHARDED_INDEX else None
+    retriever = RetrievalStage(db, k=RETRIEVAL_K, hybrid=hybrid, shards=shards)
+    if PREWARM:
+        # Loads the sentence-transformer weights and pages in the HNSW index
+        retriever.retrieve(retriever.embed("warm up"), None)
+        if hybrid is not None:
+            hybrid.reranker()
+    return db, retriever
+
+# Shared by all users - never keyed on the API key
+def build_answer_cache():
+    return SemanticAnswerCache(
+        os.path.join(CACHE_DIR, "answers.sqlite3"),
+        threshold=ANSWER_CACHE_THRESHOLD,
+        ttl_seconds=ANSWER_CACHE_TTL_HOURS * 3600,
+        max_entries=ANSWER_CACHE_MAX_ENTRIES
+    )
+
+
+# --- STEP 3: PIPELINE FUNCTIONS (ROBUST LOGIC) ---
+def decode_image(image_bytes):
+    # Draft-mode / reduced decode near the model's input size (image_io.py)
+    with span("decode"):
+        return image_io.decode_image(image_bytes, max_pixels=MAX_DECODE_MEGAPIXELS * 1e6)
+
+def decode_error(error):
+    """Per-image error text for a failed decode, or None if `error` is not a decode failure."""
+    if isinstance(error, image_io.ImageTooLarge):
+        return str(error)
+    if isinstance(error, (UnidentifiedImageError, OSError)):
+        return "Not a readable image"
+    return None
+
+def image_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def robust_process_image(image, engine):
+    # Transforms, batching and the BMW/non-BMW decision live in vision.py / inference_engine.py
+    return engine.classify(image)
+
+# --- GEMINI FUNCTION ---
+# One long-lived client: pooled chains per key, shared rate limiting, async retries
+_llm_client = None
+
+def load_llm_client():
+    global _llm_client
+    if _llm_client is None:
+        from llm_client import GeminiClient
+        _llm_client = GeminiClient(requests_per_minute=GEMINI_REQUESTS_PER_MINUTE)
+    return _llm_client
+
+# Caching happens in generate_answer via the persistent semantic answer cache
+def ask_gemini(car_model, user_question, context_text, api_key):
+    return load_llm_client().invoke(car_model, user_question, context_text, api_key)
+
+# Streaming variant: yields text chunks, on_complete receives the full answer
+def stream_gemini(car_model, user_question, context_text, api_key, on_complete=None):
+    return load_llm_client().stream(car_model, user_question, context_text, api_key, on_complete=on_complete)
+
+def docs_to_dicts(docs):
+    return [{"page_content": d.page_content, "metadata": d.metadata} for d in docs]
+
+def docs_from_dicts(sources):
+    from langchain_core.documents import Document
+    return [Document(page_content=s["page_content"], metadata=s["metadata"]) for s in sources]
+
+def _single_chunk(text):
+    yield text
+
+def generate_answer(car_model, user_question, retriever, api_key, chassis_override=None, answer_cache=None, stream=False):
+    # Everything up to the first answer token; streamed generation is timed in llm_client
+    with span("answer", car_model=car_model, stream=stream):
+        return _generate_answer(car_model, user_question, retriever, api_key, chassis_override, answer_cache, stream)
+
+def _generate_answer(car_model, user_question, retriever, api_key, chassis_override, answer_cache, stream):
+    # With stream=True the answer is returned as a generator of text chunks
+    # (for st.write_stream) while the source docs are available immediately.
+    as_output = _single_chunk if stream else (lambda text: text)
+
+    # 1. Determine which chassis code to use
+    if chassis_override:
+        chassis_code = chassis_override
+    else:
+        chassis_code = extract_chassis_code(car_model)
+
+    try:
+        # Embed once - shared by the answer cache and every retrieval strategy
+        with span("embed"):
+            question_embedding = retriever.embed(user_question)
+    except Exception as e:
+        return as_output(f"⚠️ **Database Error:** {str(e)}"), []
+
+    # 2. Semantic cache: paraphrased questions about the same chassis share answers
+    cache_scope = chassis_code or car_model
+    if answer_cache is not None:
+        with span("answer_cache"):
+            cached = answer_cache.lookup(cache_scope, question_embedding)
+        if cached:
+            answer_content, sources, _ = cached
+            return as_output(answer_content), docs_from_dicts(sources)
+
+    # 3. Retrieval: chassis filter -> General -> global, usually in a single search
+    try:
+        with span("retrieve", chassis=chassis_code):
+            docs, used_strategy = retriever.retrieve(question_embedding, chassis_code, question=user_question)
+    except Exception as e:
+        return as_output(f"⚠️ **Database Error:** {str(e)}"), []
+    RETRIEVAL_STRATEGY.inc(strategy=used_strategy)
+
+    # Context Construction
+    if not docs:
+        return as_output("⚠️ I couldn't find any relevant manual pages for this specific issue."), []
+
+    # Dedupe, merge overlapping neighbours and fit the token budget
+    with span("context"):
+        context_text, docs, context_stats = build_context(docs, token_budget=CONTEXT_TOKEN_BUDGET)
+    for kind in ("in", "out"):
+        CONTEXT_CHUNKS.inc(context_stats[f"chunks_{kind}"], kind=kind)
+    for kind in ("in", "out", "saved"):
+        CONTEXT_TOKENS.inc(context_stats[f"tokens_{kind}"], kind=kind)
+    full_prompt_question = f"User Question: {user_question}\n(Search Strategy Used: {used_strategy})"
+
+    if stream:
+        # The completed text still goes into the answer cache once streaming finishes
+        def store_answer(answer_content):
+            if answer_cache is not None:
+                answer_cache.store(cache_scope, user_question, question_embedding, answer_content, docs_to_dicts(docs))
+
+        return stream_gemini(car_model, full_prompt_question, context_text, api_key, on_complete=store_answer), docs
+
+    with span("generate"):
+        answer_content = ask_gemini(car_model, full_prompt_question, context_text, api_key)
+
+    # Errors and quota messages are never cached
+    if answer_cache is not None and not answer_content.startswith("⚠️"):
+        answer_cache.store(cache_scope, user_question, question_embedding, answer_content, docs_to_dicts(docs))
+
+    return answer_content, docs
+
+
+# --- SHARED PIPELINE ---
+class Pipeline:
+    """The whole app minus the UI; thread-safe and meant to be shared per process."""
+
+    def __init__(self, background=FAST_START):
+        # With BMW_WORKERS > 1: this process's core slot and thread count
+        self.worker_slot, threads = configure_worker(WORKERS, os.path.join(CACHE_DIR, "worker_slots"))
+        self.loader = BackgroundLoader(background=background)
+        self.loader.start("vision", lambda: build_vision_stack(threads))
+        self.loader.start("rag", lambda: build_rag_stack(threads))
+        self.prediction_cache = build_prediction_cache()
+        self.answer_cache = build_answer_cache()
+        self._decode_pool = ThreadPoolExecutor(max_workers=DECODE_THREADS, thread_name_prefix="decode")
+        self._class_table = None
+
+    # Readiness
+    def status(self):
+        return self.loader.status()
+
+    def all_done(self):
+        return self.loader.all_done()
+
+    def state(self, name):
+        return self.loader.state(name)
+
+    def wait(self, name):
+        """Block until a component is loaded (re-raises its load error)."""
+        self.loader.result(name)
+
+    # Components (block until loaded)
+    @property
+    def engine(self):
+        return self.loader.result("vision")[4]
+
+    @property
+    def retriever(self):
+        return self.loader.result("rag")[1]
+
+    def class_names(self):
+        return self.loader.result("vision")[1]
+
+    def class_table(self):
+        # Read from the class map the model is loaded with, so it never waits on the model
+        if self._class_table is None:
+            self._class_table = ClassTable.from_class_map(CLASS_JSON_PATH)
+        return self._class_table
+
+    # Requests
+    def classify(self, image_bytes, image=None):
+        """Prediction dict for one encoded image; `image` skips decoding if the caller has it."""
+        return self.prediction_cache.get_or_compute(
+            image_hash(image_bytes),
+            lambda: robust_process_image(image if image is not None else decode_image(image_bytes), self.engine)
+        )
+
+    def classify_batch(self, images_bytes):
+        """Prediction dicts for several encoded images; cache misses go through one engine batch.
+
+        An image that cannot be decoded gets {"error": ...} and the others are still classified.
+        """
+        hashes = [image_hash(b) for b in images_bytes]
+        results = [self.prediction_cache.get(h) for h in hashes]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            engine = self.engine
+            # Decoded in parallel; the engine batches whatever the decode threads submit
+            futures = list(self._decode_pool.map(lambda i: self._submit_encoded(engine, images_bytes[i]), missing))
+            for i, future in zip(missing, futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = decode_error(e)
+                    if error is None:
+                        raise
+                    results[i] = {"error": error}
+                    continue
+                self.prediction_cache.put(hashes[i], result)
+                results[i] = result
+        return results
+
+    @staticmethod
+    def _submit_encoded(engine, image_bytes):
+        try:
+            image = decode_image(image_bytes)
+        except Exception as e:
+            failed = Future()
+            failed.set_exception(e)
+            return failed
+        return engine.submit(image)
+
+    def ask(self, car_model, question, api_key, chassis_override=None, stream=False):
+        # A predicted car's chassis comes from the class table, not from re-parsing its name
+        chassis_code = chassis_override or self.class_table().chassis_for_display(car_model)
+        return generate_answer(
+            car_model, question, self.retriever, api_key,
+            chassis_override=chassis_code,
+            answer_cache=self.answer_cache,
+            stream=stream
+        )
@@ -0,0 +1,137 @@
+# --- PERSISTENT PREDICTION CACHE ---
+# Content-addressed cache of classifier decisions keyed by the image SHA-256.
+# A small in-process LRU sits in front of a SQLite file so repeat uploads skip
+# the B4 forward pass across sessions and restarts.
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import cache_result
+
+
+def file_fingerprint(*paths, extra=""):
+    """SHA-256 over the contents of `paths` (plus `extra`), e.g. model + class map."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(extra.encode())
+    return digest.hexdigest()
+
+
+def _encode(result):
+    return json.dumps(result)
+
+
+def _decode(payload):
+    result = json.loads(payload)
+    # JSON turns the (name, score) tuples into lists; restore the original shape
+    result["chart_data"] = [tuple(p) for p in result["chart_data"]]
+    return result
+
+
+class PredictionCache:
+    """Image hash -> decision dict, invalidated whenever the model fingerprint changes."""
+
+    def __init__(self, db_path, model_fingerprint, max_entries=50000, memory_entries=1024):
+        self.model_fingerprint = model_fingerprint
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                image_hash TEXT PRIMARY KEY,
+                model_fingerprint TEXT NOT NULL,
+                result TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_predictions_access ON predictions(last_access)")
+        # Automatic invalidation: anything computed by another model/class map is stale
+        self._conn.execute("DELETE FROM predictions WHERE model_fingerprint != ?", (model_fingerprint,))
+        self._conn.commit()
+
+    def get(self, image_hash):
+        with self._lock:
+            if image_hash in self._memory:
+                self._memory.move_to_end(image_hash)
+                self.hits += 1
+                cache_result("prediction", hit=True)
+                return self._memory[image_hash]
+
+            row = self._conn.execute(
+                "SELECT result FROM predictions WHERE image_hash = ? AND model_fingerprint = ?",
+                (image_hash, self.model_fingerprint)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                cache_result("prediction", hit=False)
+                return None
+
+            self._conn.execute(
+                "UPDATE predictions SET last_access = ? WHERE image_hash = ?", (time.time(), image_hash)
+            )
+            self._conn.commit()
+            result = _decode(row[0])
+            self._remember(image_hash, result)
+            self.hits += 1
+            cache_result("prediction", hit=True)
+            return result
+
+    def put(self, image_hash, result):
+        with self._lock:
+            self._remember(image_hash, result)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)",
+                (image_hash, self.model_fingerprint, _encode(result), time.time())
+            )
+            self._evict()
+            self._conn.commit()
+
+    def get_or_compute(self, image_hash, compute):
+        result = self.get(image_hash)
+        if result is None:
+            result = compute()
+            self.put(image_hash, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM predictions")
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # --- INTERNALS ---
+    def _remember(self, image_hash, result):
+        self._memory[image_hash] = result
+        self._memory.move_to_end(image_hash)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        # LRU on disk: drop the least recently used rows beyond max_entries
+        count = self._conn.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM predictions WHERE image_hash IN "
+                "(SELECT image_hash FROM predictions ORDER BY last_access ASC LIMIT ?)",
+                (excess,)
+            )
@@ -0,0 +1,82 @@
+# --- RETRIEVAL STAGE ---
+# Embeds the question once and searches Chroma by vector with the same
+# precedence generate_answer always used: chassis -> General -> global.
+#
+# A filtered search only comes back empty when no chunk carries that
+# car_model, which is a property of the collection rather than the query.
+# We remember which car_model values exist, so the common path is a single
+# HNSW traversal instead of up to three.
+#
+# With a HybridSearcher (hybrid_search.py) each strategy runs BM25 + vector
+# fusion inside the same car_model partition instead of a pure vector search.
+#
+# With a ShardRouter (sharded_index.py) chassis-filtered vector searches go to
+# that car_model's own shard, so no metadata filtering happens at query time.
+# The global strategy keeps using the full Chroma collection.
+import threading
+
+from metrics import span
+
+STRATEGY_SPECIFIC = "Specific"
+STRATEGY_GENERAL = "General Fallback"
+STRATEGY_GLOBAL = "Global (Last Resort)"
+
+
+class RetrievalStage:
+    def __init__(self, db, k=8, hybrid=None, shards=None):
+        self.db = db
+        self.k = k
+        self.hybrid = hybrid
+        self.shards = shards
+        self._has_model = {}
+        self._lock = threading.Lock()
+
+    def embed(self, text):
+        return self.db.embeddings.embed_query(text)
+
+    def has_car_model(self, car_model):
+        """True if any chunk is tagged with `car_model` (memoized per value)."""
+        with self._lock:
+            if car_model not in self._has_model:
+                if self.shards is not None and self.shards.has(car_model):
+                    self._has_model[car_model] = True
+                    return True
+                found = self.db.get(where={"car_model": car_model}, limit=1, include=[])
+                self._has_model[car_model] = bool(found["ids"])
+            return self._has_model[car_model]
+
+    def plan(self, chassis_code):
+        """Ordered (strategy, filter) pairs to try; the first one is usually the only one run."""
+        steps = []
+        if chassis_code and chassis_code != "General" and self.has_car_model(chassis_code):
+            steps.append((STRATEGY_SPECIFIC, {"car_model": chassis_code}))
+        if self.has_car_model("General"):
+            steps.append((STRATEGY_GENERAL, {"car_model": "General"}))
+        steps.append((STRATEGY_GLOBAL, None))
+        return steps
+
+    def vector_search(self, question_embedding, k, search_filter=None):
+        """Route a vector search to the car_model's shard when there is one."""
+        if search_filter and self.shards is not None and self.shards.has(search_filter["car_model"]):
+            with span("vector_search", index="shard"):
+                return self.shards.search(question_embedding, k, search_filter["car_model"])
+        with span("vector_search", index="chroma"):
+            return self.db.similarity_search_by_vector(question_embedding, k=k, filter=search_filter)
+
+    def search(self, question_embedding, search_filter, question=None):
+        if self.hybrid is not None and question:
+            return self.hybrid.search(question, question_embedding, self.k, search_filter,
+                                      vector_search=self.vector_search)
+        return self.vector_search(question_embedding, self.k, search_filter)
+
+    def retrieve(self, question_embedding, chassis_code, question=None):
+        """Return (docs, strategy) for an already-embedded question.
+
+        `question` (the raw text) enables the keyword half of hybrid search.
+        """
+        docs, used_strategy = [], STRATEGY_GLOBAL
+        for used_strategy, search_filter in self.plan(chassis_code):
+            docs = self.search(question_embedding, search_filter, question)
+            if docs:
+                break
+        return docs, used_strategy
@@ -0,0 +1,166 @@
+# --- OFFLINE RETRIEVAL EVALUATION ---
+# Recall@k, MRR, prompt size and latency of retrieval against the Chroma DB,
+# for every strategy of the retrieval plan and every index configuration
+# (k, vector vs hybrid, full collection vs per-chassis shards).
+#
+# Input: JSONL, one labelled question per line:
+#   {"chassis": "E46", "question": "Front control arm bushing torque?",
+#    "expected": [{"source": "E46_bentley.pdf", "page": 312}]}
+# ("expected_source" / "expected_page" work for a single expected hit.)
+# A retrieved chunk is relevant when the expected source appears in its
+# source / filename / title and, if a page is given, the page matches.
+#
+#   cd src && python -m retrieval_eval --eval-set ../eval/retrieval.jsonl --k 4,6,8
+import argparse
+import itertools
+import json
+import time
+
+import numpy as np
+
+import pipeline
+from benchmark import summarize
+from context_builder import build_context
+from hybrid_search import BM25Index, HybridSearcher
+from retrieval import RetrievalStage
+from sharded_index import ShardRouter
+
+PLAN = "plan"  # what retrieve() actually returns (first non-empty strategy)
+
+
+def load_eval_set(path):
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            expected = row.get("expected")
+            if expected is None:
+                expected = [{"source": row["expected_source"], "page": row.get("expected_page")}]
+            if not expected:
+                raise ValueError(f"line {line_no}: no expected source")
+            queries.append({"chassis": row.get("chassis"), "question": row["question"], "expected": expected})
+    return queries
+
+
+def is_relevant(doc, expected):
+    meta = doc.metadata
+    haystack = " ".join(str(meta.get(key, "")) for key in ("source", "filename", "title")).lower()
+    if expected["source"].lower() not in haystack:
+        return False
+    return expected.get("page") is None or meta.get("page") == expected["page"]
+
+
+def score(docs, expected):
+    """(recall, reciprocal rank) of one ranked result list."""
+    found = sum(any(is_relevant(d, e) for d in docs) for e in expected)
+    first = next((rank for rank, d in enumerate(docs, 1) if any(is_relevant(d, e) for e in expected)), None)
+    return found / len(expected), (1.0 / first if first else 0.0)
+
+
+def build_stages(db, k_values, searches, indexes):
+    """RetrievalStage per available (k, search, index) combination."""
+    bm25 = BM25Index.load(pipeline.DB_PATH) if "hybrid" in searches else None
+    shards = ShardRouter.load(pipeline.DB_PATH) if "sharded" in indexes else None
+    if "hybrid" in searches and bm25 is None:
+        print("  skipping hybrid configs: no bm25/ index in the DB folder")
+        searches = [s for s in searches if s != "hybrid"]
+    if "sharded" in indexes and shards is None:
+        print("  skipping sharded configs: no shards/ in the DB folder")
+        indexes = [i for i in indexes if i != "sharded"]
+
+    stages = {}
+    for k, search, index in itertools.product(k_values, searches, indexes):
+        hybrid = HybridSearcher(db, bm25, candidates=pipeline.HYBRID_CANDIDATES) if search == "hybrid" else None
+        stages[f"k={k} {search} {index}"] = RetrievalStage(
+            db, k=k, hybrid=hybrid, shards=shards if index == "sharded" else None
+        )
+    return stages
+
+
+def evaluate(stages, queries, embed):
+    """{config: {strategy: rows}}; each row is one query's recall / rr / tokens / ms."""
+    results = {config: {} for config in stages}
+    for query in queries:
+        embedding = embed(query["question"])
+        for config, stage in stages.items():
+            runs = [(strategy, lambda f=search_filter: stage.search(embedding, f, query["question"]))
+                    for strategy, search_filter in stage.plan(query["chassis"])]
+            runs.append((PLAN, lambda: stage.retrieve(embedding, query["chassis"], question=query["question"])[0]))
+            for strategy, run in runs:
+                start = time.perf_counter()
+                docs = run()
+                ms = (time.perf_counter() - start) * 1000
+                recall, rr = score(docs, query["expected"])
+                tokens = build_context(docs)[2]["tokens_out"] if docs else 0
+                results[config].setdefault(strategy, []).append(
+                    {"recall": recall, "rr": rr, "tokens": tokens, "ms": ms}
+                )
+    return results
+
+
+def report(results):
+    summary = {}
+    print(f"\n{'config':<26}{'strategy':<22}{'n':>5}{'recall@k':>10}{'MRR':>8}{'tokens':>8}{'p50 ms':>9}{'p95 ms':>9}")
+    for config, strategies in results.items():
+        summary[config] = {}
+        for strategy, rows in strategies.items():
+            latency = summarize([r["ms"] for r in rows])
+            entry = {
+                "queries": len(rows),
+                "recall_at_k": float(np.mean([r["recall"] for r in rows])),
+                "mrr": float(np.mean([r["rr"] for r in rows])),
+                "mean_context_tokens": float(np.mean([r["tokens"] for r in rows])),
+                "latency": latency,
+            }
+            summary[config][strategy] = entry
+            print(f"{config:<26}{strategy:<22}{entry['queries']:>5}{entry['recall_at_k']:>10.3f}{entry['mrr']:>8.3f}"
+                  f"{entry['mean_context_tokens']:>8.0f}{latency['p50_ms']:>9.1f}{latency['p95_ms']:>9.1f}")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval recall/MRR/latency on a labelled question set.")
+    parser.add_argument("--eval-set", required=True, help="JSONL of chassis / question / expected source+page")
+    parser.add_argument("--k", default="8", help="Comma-separated k values, e.g. 4,6,8")
+    parser.add_argument("--search", default="vector,hybrid", help="vector and/or hybrid")
+    parser.add_argument("--index", default="chroma,sharded", help="chroma and/or sharded")
+    parser.add_argument("--out", help="Write the summary as JSON")
+    args = parser.parse_args()
+
+    queries = load_eval_set(args.eval_set)
+    print(f"Loaded {len(queries)} labelled questions")
+
+    from langchain_chroma import Chroma
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    db = Chroma(persist_directory=pipeline.DB_PATH,
+                embedding_function=HuggingFaceEmbeddings(model_name=pipeline.EMBEDDING_MODEL))
+    stages = build_stages(db, [int(k) for k in args.k.split(",")], args.search.split(","), args.index.split(","))
+    if not stages:
+        parser.error("no index configuration is available")
+
+    embed_ms = []
+
+    def embed(text):
+        start = time.perf_counter()
+        vector = db.embeddings.embed_query(text)
+        embed_ms.append((time.perf_counter() - start) * 1000)
+        return vector
+
+    embed("warm up")
+    embed_ms.clear()
+    summary = report(evaluate(stages, queries, embed))
+    embed_latency = summarize(embed_ms)
+    print(f"\nQuery embedding: p50 {embed_latency['p50_ms']:.1f}ms, p95 {embed_latency['p95_ms']:.1f}ms "
+          f"(not included above)")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"eval_set": args.eval_set, "embed_latency": embed_latency, "configs": summary}, f, indent=2)
+        print(f"✅ Wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
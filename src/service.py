@@ -0,0 +1,122 @@
+# --- HTTP SERVICE ---
+# The BMWChat pipeline behind plain HTTP, so it can sit behind a load balancer
+# and be called by other services (the Streamlit UI included, via BMW_API_URL).
+#
+#   cd src && uvicorn service:app --host 0.0.0.0 --port 8000 --workers 4
+#
+# Each worker process holds one Pipeline (model, embeddings, Chroma, caches)
+# shared by all of its request threads. With several workers on one machine,
+# set BMW_TORCH_THREADS to about cores / workers so they don't oversubscribe.
+#
+#   GET  /health          readiness of each component (503 until all loaded)
+#   GET  /classes         class names known to the classifier
+#   POST /classify        multipart "file" -> prediction (413 if too large to decode)
+#   POST /classify/batch  multipart "files" -> predictions, batched on the model;
+#                         an unreadable or oversized image gets {"error": ...}
+#   POST /ask             JSON question -> answer + sources (NDJSON when streamed);
+#                         the Gemini key goes in the X-Gemini-Api-Key header
+#   GET  /metrics         Prometheus metrics of this worker (metrics.py)
+import json
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import FastAPI, File, Header, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from PIL import UnidentifiedImageError
+from pydantic import BaseModel
+
+import metrics
+from image_io import ImageTooLarge
+from pipeline import STARTUP_LABELS, Pipeline, docs_to_dicts
+from warmup import READY
+
+pipeline = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global pipeline
+    # Loads in the background so /health answers (503) while models warm up
+    pipeline = Pipeline(background=True)
+    yield
+
+
+app = FastAPI(title="BMWChat", lifespan=lifespan)
+
+
+class AskRequest(BaseModel):
+    car_model: str
+    question: str
+    chassis_code: Optional[str] = None
+    stream: bool = False
+
+
+def _require(name):
+    try:
+        pipeline.wait(name)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"{STARTUP_LABELS[name]} failed to load: {e}")
+
+
+def _bad_image(filename):
+    return HTTPException(status_code=400, detail=f"Not a readable image: {filename}")
+
+
+@app.get("/health")
+def health():
+    components = {
+        name: {"state": state, "seconds": round(seconds, 1), "error": str(error) if error else None}
+        for name, (state, seconds, error) in pipeline.status().items()
+    }
+    ready = all(c["state"] == READY for c in components.values())
+    return JSONResponse({"ready": ready, "components": components}, status_code=200 if ready else 503)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/classes")
+def classes():
+    _require("vision")
+    return {"classes": pipeline.class_names()}
+
+
+# Plain `def` endpoints run on the server's thread pool; the inference engine
+# batches whatever those threads submit concurrently.
+@app.post("/classify")
+def classify(file: UploadFile = File(...)):
+    _require("vision")
+    try:
+        return pipeline.classify(file.file.read())
+    except ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except (UnidentifiedImageError, OSError):
+        raise _bad_image(file.filename)
+
+
+@app.post("/classify/batch")
+def classify_batch(files: List[UploadFile] = File(...)):
+    _require("vision")
+    return {"results": pipeline.classify_batch([f.file.read() for f in files])}
+
+
+@app.post("/ask")
+def ask(request: AskRequest, x_gemini_api_key: str = Header(...)):
+    _require("rag")
+    answer, sources = pipeline.ask(
+        request.car_model, request.question, x_gemini_api_key,
+        chassis_override=request.chassis_code,
+        stream=request.stream
+    )
+    if not request.stream:
+        return {"answer": answer, "sources": docs_to_dicts(sources)}
+
+    # First line carries the sources, then one line per text chunk
+    def ndjson():
+        yield json.dumps({"sources": docs_to_dicts(sources)}) + "\n"
+        for chunk in answer:
+            yield json.dumps({"text": chunk}) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
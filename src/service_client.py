@@ -0,0 +1,107 @@
+# --- HTTP CLIENT FOR service.py ---
+# Same interface as pipeline.Pipeline, so bmw.py can run as a thin client
+# (BMW_API_URL=http://host:8000) without loading any model itself.
+import json
+import time
+
+import requests
+
+from class_metadata import ClassTable
+from pipeline import docs_from_dicts
+from warmup import FAILED, LOADING
+
+
+def describe_service_error(error):
+    """'413: <detail>' for an HTTPError from service.py (FastAPI puts the reason in "detail")."""
+    response = error.response
+    if response is None:
+        return str(error)
+    try:
+        detail = response.json().get("detail")
+    except ValueError:
+        detail = None
+    return f"{response.status_code}: {detail or response.reason}"
+
+
+class RemotePipeline:
+    def __init__(self, base_url, timeout=120):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self._class_table = None
+
+    def _url(self, path):
+        return f"{self.base_url}{path}"
+
+    # Readiness
+    def status(self):
+        try:
+            # /health answers 503 until every component is ready
+            components = self.session.get(self._url("/health"), timeout=10).json()["components"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            return {"service": (FAILED, 0.0, ConnectionError(f"{self.base_url} unreachable: {e}"))}
+        return {
+            name: (c["state"], c["seconds"], RuntimeError(c["error"]) if c["error"] else None)
+            for name, c in components.items()
+        }
+
+    def all_done(self):
+        return all(state != LOADING for state, _, _ in self.status().values())
+
+    def state(self, name):
+        return self.status().get(name, (FAILED, 0.0, None))[0]
+
+    def wait(self, name, poll_seconds=1.0):
+        while True:
+            state, _, error = self.status().get(name, (FAILED, 0.0, KeyError(name)))
+            if state == FAILED:
+                raise error
+            if state != LOADING:
+                return
+            time.sleep(poll_seconds)
+
+    def class_names(self):
+        response = self.session.get(self._url("/classes"), timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["classes"]
+
+    def class_table(self):
+        if self._class_table is None:
+            self._class_table = ClassTable(self.class_names())
+        return self._class_table
+
+    # Requests
+    def classify(self, image_bytes, image=None):
+        response = self.session.post(self._url("/classify"), files={"file": ("upload", image_bytes)},
+                                     timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def classify_batch(self, images_bytes):
+        files = [("files", (f"upload{i}", b)) for i, b in enumerate(images_bytes)]
+        response = self.session.post(self._url("/classify/batch"), files=files, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["results"]
+
+    def ask(self, car_model, question, api_key, chassis_override=None, stream=False):
+        response = self.session.post(
+            self._url("/ask"),
+            json={"car_model": car_model, "question": question, "chassis_code": chassis_override, "stream": stream},
+            headers={"X-Gemini-Api-Key": api_key},
+            stream=stream,
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        if not stream:
+            payload = response.json()
+            return payload["answer"], docs_from_dicts(payload["sources"])
+
+        lines = response.iter_lines(decode_unicode=True)
+        sources = json.loads(next(lines))["sources"]
+
+        def chunks():
+            for line in lines:
+                if line:
+                    yield json.loads(line)["text"]
+
+        return chunks(), docs_from_dicts(sources)
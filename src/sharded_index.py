@@ -0,0 +1,198 @@
+# --- PER-CHASSIS SHARDED VECTOR INDEXES ---
+# One small index per car_model value (E30, E36, E46, ..., General) stored in
+# <db>/shards/. A known-chassis question then searches only that chassis'
+# chunks instead of filtering the whole HNSW graph by metadata.
+#
+# Each shard is a float32 matrix in a .npy file, opened memory-mapped on first
+# use and searched exactly (same L2 ranking Chroma uses). Chunk texts and
+# metadata sit in a JSON-lines file indexed by byte offsets, also memory-mapped;
+# only the top-k lines of a search are parsed. Shards for chassis nobody asks
+# about are evicted, so resident memory tracks actual traffic.
+#
+# Every build goes into a new <db>/shards/<version>/ directory and the CURRENT
+# pointer file is swapped atomically, so a running app never finds the
+# directory missing or half-written.
+#
+# Build or refresh after ingestion:
+#   cd src && python -m sharded_index --db-path ../models/bmw_knowledge_db_rag_paddleocr
+import argparse
+import json
+import mmap
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+SHARDS_DIR = "shards"
+SHARD_MANIFEST = "shards.json"
+CURRENT_POINTER = "CURRENT"  # name of the live version directory
+
+
+def shard_dirname(car_model):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", car_model)
+
+
+class Shard:
+    def __init__(self, path):
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.sq_norms = np.load(os.path.join(path, "sq_norms.npy"))
+        # offsets[i]:offsets[i + 1] is chunk i's line in chunks.jsonl
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        with open(os.path.join(path, "chunks.jsonl"), 'rb') as f:
+            self.chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def chunk(self, i):
+        return json.loads(self.chunks[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def search(self, embedding, k):
+        from langchain_core.documents import Document
+
+        query = np.asarray(embedding, dtype=np.float32)
+        # ||v - q||^2 up to the constant ||q||^2
+        distances = self.sq_norms - 2.0 * (self.vectors @ query)
+        k = min(k, len(distances))
+        if k == 0:
+            return []
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        chunks = [self.chunk(i) for i in top]
+        return [Document(id=c["id"], page_content=c["text"], metadata=c["metadata"]) for c in chunks]
+
+
+class ShardRouter:
+    """Lazily opens per-car_model shards and keeps at most `max_open` of them resident."""
+
+    def __init__(self, db_path, max_open=6):
+        self.shards_dir = os.path.join(db_path, SHARDS_DIR)
+        self.max_open = max_open
+        self._open = OrderedDict()
+        self._lock = threading.Lock()
+        self._switch_version()
+
+    @classmethod
+    def load(cls, db_path, **kwargs):
+        if not os.path.exists(os.path.join(db_path, SHARDS_DIR, CURRENT_POINTER)):
+            if os.path.exists(os.path.join(db_path, SHARDS_DIR, SHARD_MANIFEST)):
+                print("⚠️ Ignoring shards in the old layout; rebuild them with `python -m sharded_index`")
+            return None
+        return cls(db_path, **kwargs)
+
+    def _switch_version(self):
+        """(Re)read the CURRENT pointer; shards already open keep serving their mapped files."""
+        with open(os.path.join(self.shards_dir, CURRENT_POINTER), 'r') as f:
+            self.version = f.read().strip()
+        self.root = os.path.join(self.shards_dir, self.version)
+        with open(os.path.join(self.root, SHARD_MANIFEST), 'r') as f:
+            self.manifest = json.load(f)  # car_model -> {"dir", "count"}
+
+    def has(self, car_model):
+        return car_model in self.manifest
+
+    def shard(self, car_model):
+        with self._lock:
+            if car_model in self._open:
+                self._open.move_to_end(car_model)
+                return self._open[car_model]
+            try:
+                shard = Shard(os.path.join(self.root, self.manifest[car_model]["dir"]))
+            except FileNotFoundError:
+                # Our version was cleaned up by a later build: move to the live one
+                self._switch_version()
+                self._open.clear()
+                shard = Shard(os.path.join(self.root, self.manifest[car_model]["dir"]))
+            self._open[car_model] = shard
+            while len(self._open) > self.max_open:
+                # Dropping the memmap releases its pages
+                self._open.popitem(last=False)
+            return shard
+
+    def search(self, embedding, k, car_model):
+        return self.shard(car_model).search(embedding, k)
+
+
+def build_shards(db, db_path, page_size=5000):
+    """Split the Chroma collection into one shard per car_model (reuses stored embeddings)."""
+    groups = defaultdict(lambda: ([], []))
+    offset = 0
+    while True:
+        page = db.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        if not len(page["ids"]):
+            break
+        for doc_id, vector, text, meta in zip(page["ids"], page["embeddings"], page["documents"], page["metadatas"]):
+            meta = meta or {}
+            car_model = meta.get("car_model", "Unknown")
+            groups[car_model][0].append(np.asarray(vector, dtype=np.float32))
+            groups[car_model][1].append({"id": doc_id, "text": text, "metadata": meta})
+        offset += len(page["ids"])
+
+    # Build a new version next to the live one; readers only ever follow CURRENT
+    shards_dir = os.path.join(db_path, SHARDS_DIR)
+    version = f"v{time.time_ns()}"
+    staging = os.path.join(shards_dir, version)
+    os.makedirs(staging)
+
+    manifest = {}
+    for car_model, (vectors, chunks) in groups.items():
+        dirname = shard_dirname(car_model)
+        path = os.path.join(staging, dirname)
+        os.makedirs(path)
+        matrix = np.stack(vectors)
+        np.save(os.path.join(path, "vectors.npy"), matrix)
+        np.save(os.path.join(path, "sq_norms.npy"), (matrix * matrix).sum(axis=1))
+        offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+        with open(os.path.join(path, "chunks.jsonl"), 'wb') as f:
+            for i, chunk in enumerate(chunks):
+                f.write(json.dumps(chunk).encode('utf-8') + b"\n")
+                offsets[i + 1] = f.tell()
+        np.save(os.path.join(path, "offsets.npy"), offsets)
+        manifest[car_model] = {"dir": dirname, "count": len(chunks)}
+
+    with open(os.path.join(staging, SHARD_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    pointer = os.path.join(shards_dir, CURRENT_POINTER)
+    previous = None
+    if os.path.exists(pointer):
+        with open(pointer, 'r') as f:
+            previous = f.read().strip()
+    with open(pointer + ".tmp", 'w') as f:
+        f.write(version)
+    os.replace(pointer + ".tmp", pointer)
+
+    # Keep the version running apps may still be opening shards from; drop older
+    # ones (and files from the pre-versioned layout). Routers on a dropped version
+    # move to CURRENT when they next open a shard.
+    for name in os.listdir(shards_dir):
+        if name not in (CURRENT_POINTER, version, previous):
+            path = os.path.join(shards_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+    return manifest
+
+
+def main():
+    from langchain_chroma import Chroma
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+    default_db = os.path.join(os.path.dirname(current_folder), "models", "bmw_knowledge_db_rag_paddleocr")
+
+    parser = argparse.ArgumentParser(description="Build one vector shard per car_model next to the Chroma DB.")
+    parser.add_argument("--db-path", default=default_db)
+    args = parser.parse_args()
+
+    start = time.time()
+    db = Chroma(persist_directory=args.db_path, embedding_function=HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2"))
+    manifest = build_shards(db, args.db_path)
+    print(f"✅ Built {len(manifest)} shards ({sum(m['count'] for m in manifest.values())} chunks) "
+          f"in {time.time() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    main()
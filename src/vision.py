@@ -0,0 +1,226 @@
+# --- VISION CORE (NO STREAMLIT) ---
+# Model loading, preprocessing and the BMW / non-BMW decision logic used by
+# bmw.py. Kept free of Streamlit so bulk jobs can import it directly.
+import json
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models, transforms
+from torchvision.transforms import functional as TF
+
+from class_metadata import is_bmw_class
+
+IMAGE_SIZE = 380
+NORMALIZE_MEAN = [0.485, 0.456, 0.406]
+NORMALIZE_STD = [0.229, 0.224, 0.225]
+
+# EfficientNet B4 native transforms (built once, reused for every image)
+VISION_TRANSFORM = transforms.Compose([
+    transforms.Resize(IMAGE_SIZE),
+    transforms.CenterCrop(IMAGE_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(NORMALIZE_MEAN, NORMALIZE_STD)
+])
+
+# The same transform split in two, for pipelines that resize in worker
+# processes: resize_crop() per PIL image, then normalize_batch() on the stack.
+RESIZE_CROP = transforms.Compose([
+    transforms.Resize(IMAGE_SIZE),
+    transforms.CenterCrop(IMAGE_SIZE),
+])
+# Resized but not yet cropped, so test-time augmentation can take other crops;
+# center_crop() of it equals VISION_TRANSFORM's output
+RESIZE_NORMALIZE = transforms.Compose([
+    transforms.Resize(IMAGE_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(NORMALIZE_MEAN, NORMALIZE_STD)
+])
+# off: single center crop | adaptive: extra views only for low-margin images | always
+TTA_MODES = ("off", "adaptive", "always")
+_MEAN = torch.tensor(NORMALIZE_MEAN).view(1, 3, 1, 1)
+_STD = torch.tensor(NORMALIZE_STD).view(1, 3, 1, 1)
+
+
+def load_class_map(class_json_path):
+    with open(class_json_path, 'r') as f:
+        class_map = json.load(f)
+    # Integer-keyed map for logic
+    idx_to_class = {int(k): v for k, v in class_map.items()}
+    classes = [idx_to_class[i] for i in range(len(idx_to_class))]
+    return classes, idx_to_class
+
+
+def build_model(num_classes):
+    model = models.efficientnet_b4(weights=None)
+    num_features = model.classifier[1].in_features
+    model.classifier[1] = nn.Linear(num_features, num_classes)
+    return model
+
+
+class ClassGroups:
+    """BMW / non-BMW class index masks, computed once per class map."""
+
+    def __init__(self, idx_to_class):
+        num_classes = len(idx_to_class)
+        self.bmw_indices = [idx for idx, name in idx_to_class.items() if is_bmw_class(name)]
+        self.non_bmw_indices = [idx for idx, name in idx_to_class.items() if not is_bmw_class(name)]
+
+        self.bmw_mask = torch.zeros(num_classes, dtype=torch.bool)
+        self.bmw_mask[self.bmw_indices] = True
+        self.non_bmw_mask = torch.zeros(num_classes, dtype=torch.bool)
+        self.non_bmw_mask[self.non_bmw_indices] = True
+
+
+def load_classifier(model_path, class_json_path, mmap=False):
+    """Load the B4 classifier on CPU. Raises RuntimeError on an architecture mismatch.
+
+    mmap=True maps the weights from the checkpoint file instead of copying them,
+    so every process loading the same file shares one copy (workers.py).
+    """
+    classes, idx_to_class = load_class_map(class_json_path)
+    if mmap:
+        from workers import load_state_dict_mmap
+
+        # No random init to throw away: parameters start on the meta device
+        with torch.device("meta"):
+            model = build_model(len(classes))
+        load_state_dict_mmap(model, model_path)
+    else:
+        model = build_model(len(classes))
+        model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
+    model.eval()
+    return model, classes, idx_to_class, ClassGroups(idx_to_class)
+
+
+def preprocess(image):
+    return VISION_TRANSFORM(image)
+
+
+def resize_crop(image):
+    """uint8 (380, 380, 3) array; cheap to send between processes."""
+    return np.asarray(RESIZE_CROP(image), dtype=np.uint8)
+
+
+def normalize_batch(arrays):
+    """Stack resize_crop() outputs into a model-ready (N, 3, 380, 380) batch."""
+    batch = torch.from_numpy(np.stack(arrays)).permute(0, 3, 1, 2).float().div(255)
+    return (batch - _MEAN) / _STD
+
+
+def preprocess_resized(image):
+    return RESIZE_NORMALIZE(image)
+
+
+def center_crop(resized):
+    return TF.center_crop(resized, IMAGE_SIZE)
+
+
+def predict_probs(model, batch):
+    with torch.no_grad():
+        outputs = model(batch)
+        return F.softmax(outputs, dim=1)
+
+
+def _masked_best(probs, mask):
+    # Masked argmax per row; torch.argmax keeps the first index on ties like max()
+    masked = probs.masked_fill(~mask, float("-inf"))
+    return masked.argmax(dim=1)
+
+
+def decide_batch(probs, classes, groups, top_k=3, tta_rows=()):
+    """Structured decisions for an (N, C) probability batch, one dict per row.
+
+    tta_rows are the rows whose probabilities include the flip pass (inference_engine.py).
+    """
+    # Sum Probabilities (The Ferrari & 26% Fix) - float64 to match Python float sums
+    probs64 = probs.double()
+    bmw_totals = (probs64 * groups.bmw_mask).sum(dim=1).tolist()
+    non_bmw_totals = (probs64 * groups.non_bmw_mask).sum(dim=1).tolist()
+
+    # Find Specific Model Leaders
+    top_probs, top_indices = torch.topk(probs, min(top_k, probs.shape[1]), dim=1)
+    top_probs = top_probs.tolist()
+    top_indices = top_indices.tolist()
+
+    best_bmw = _masked_best(probs, groups.bmw_mask)
+    best_bmw_probs = probs.gather(1, best_bmw.unsqueeze(1)).squeeze(1).tolist()
+    best_bmw = best_bmw.tolist()
+    best_non = _masked_best(probs, groups.non_bmw_mask).tolist() if groups.non_bmw_indices else None
+
+    # class_index / chart_indices index the class map (class_metadata.ClassTable);
+    # -1 is "Unknown Non-BMW", a model without non-BMW classes
+    results = []
+    for row in range(probs.shape[0]):
+        chart_data = [(classes[idx], score * 100) for idx, score in zip(top_indices[row], top_probs[row])]
+
+        if non_bmw_totals[row] > bmw_totals[row]:
+            index = best_non[row] if best_non is not None else -1
+            results.append({
+                "is_valid": False,
+                "display_name": classes[index] if index >= 0 else "Unknown Non-BMW",
+                "class_index": index,
+                "raw_score": best_bmw_probs[row] * 100,
+                "category_score": non_bmw_totals[row] * 100,
+                "chart_data": chart_data,
+                "chart_indices": top_indices[row],
+                "tta": row in tta_rows
+            })
+        else:
+            results.append({
+                "is_valid": True,
+                "display_name": classes[best_bmw[row]],
+                "class_index": best_bmw[row],
+                "raw_score": best_bmw_probs[row] * 100,
+                "category_score": bmw_totals[row] * 100,
+                "chart_data": chart_data,
+                "chart_indices": top_indices[row],
+                "tta": row in tta_rows
+            })
+    return results
+
+
+# --- TEST-TIME AUGMENTATION ---
+def decision_margins(probs, groups):
+    """Per-row confidence margin: the smaller of the top-1 / top-2 class gap and the BMW / non-BMW gap."""
+    top2 = torch.topk(probs, 2, dim=1).values
+    class_gap = top2[:, 0] - top2[:, 1]
+    group_gap = ((probs * groups.bmw_mask).sum(dim=1) - (probs * groups.non_bmw_mask).sum(dim=1)).abs()
+    return torch.minimum(class_gap, group_gap)
+
+
+def tta_views(resized):
+    """Extra views of one resized (3, H, W) image: the mirrored center crop, plus crops at both ends of the long side."""
+    views = [TF.hflip(center_crop(resized))]
+    _, height, width = resized.shape
+    if width > IMAGE_SIZE:
+        views += [resized[:, :, :IMAGE_SIZE], resized[:, :, width - IMAGE_SIZE:]]
+    elif height > IMAGE_SIZE:
+        views += [resized[:, :IMAGE_SIZE, :], resized[:, height - IMAGE_SIZE:, :]]
+    return torch.stack(views)
+
+
+def average_tta(model, probs, resized, rows):
+    """Average each listed row's center-crop probabilities with its TTA views, in one forward batch."""
+    views = [tta_views(resized[row]) for row in rows]
+    extra = predict_probs(model, torch.cat(views))
+    start = 0
+    for row, row_views in zip(rows, views):
+        end = start + len(row_views)
+        probs[row] = (probs[row] + extra[start:end].sum(dim=0)) / (len(row_views) + 1)
+        start = end
+    return probs
+
+
+def classify_tensors(batch, model, classes, groups):
+    """Run a stacked (N, 3, 380, 380) batch and return one decision dict per image."""
+    probs = predict_probs(model, batch)
+    return decide_batch(probs, classes, groups)
+
+
+def classify_images(images, model, classes, groups):
+    if not images:
+        return []
+    batch = torch.stack([preprocess(image) for image in images])
+    return classify_tensors(batch, model, classes, groups)
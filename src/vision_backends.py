@@ -0,0 +1,245 @@
+# --- CPU INFERENCE BACKENDS FOR THE B4 CLASSIFIER ---
+# Every backend returns a callable that maps a normalized (N, 3, 380, 380)
+# batch to logits, so it can be dropped in wherever the fp32 model is used.
+#
+# Check agreement against fp32 before switching:
+#   python -m vision_backends --images path/to/held_out --modes dynamic_int8,bf16,compile
+import argparse
+import copy
+import os
+import time
+
+import torch
+
+from vision import ClassGroups, classify_tensors, load_class_map, load_classifier, preprocess
+
+BACKEND_MODES = [
+    "fp32", "dynamic_int8", "static_int8", "bf16", "compile", "torchscript", "onnx"
+]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+class AutocastModel:
+    """channels_last + bfloat16 autocast wrapper; returns fp32 logits."""
+
+    def __init__(self, model):
+        self.model = model.to(memory_format=torch.channels_last)
+
+    def __call__(self, batch):
+        batch = batch.contiguous(memory_format=torch.channels_last)
+        with torch.autocast("cpu", dtype=torch.bfloat16):
+            return self.model(batch).float()
+
+
+class OnnxModel:
+    """onnxruntime session exposed like a torch module."""
+
+    def __init__(self, path, num_threads=None):
+        import onnxruntime as ort  # optional dependency, only needed for this backend
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        outputs = self.session.run(None, {self.input_name: batch.numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+# --- BUILDERS ---
+def quantize_dynamic_int8(model):
+    # Dynamic quantization only covers nn.Linear; the conv trunk stays fp32
+    return torch.ao.quantization.quantize_dynamic(
+        copy.deepcopy(model), {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def quantize_static_int8(model, calibration_batch):
+    """FX graph mode post-training quantization calibrated on real images."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    qconfig_mapping = get_default_qconfig_mapping("x86")
+    prepared = prepare_fx(copy.deepcopy(model), qconfig_mapping, example_inputs=(calibration_batch[:1],))
+    with torch.no_grad():
+        for chunk in calibration_batch.split(8):
+            prepared(chunk)
+    return convert_fx(prepared)
+
+
+def export_torchscript(model, path):
+    example = torch.randn(1, 3, 380, 380)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    traced.save(path)
+    return path
+
+
+def export_onnx(model, path):
+    example = torch.randn(1, 3, 380, 380)
+    torch.onnx.export(
+        model, example, path,
+        input_names=["images"], output_names=["logits"],
+        dynamic_axes={"images": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17
+    )
+    return path
+
+
+def load_torchscript(path):
+    # No torchvision constructor needed - the graph and weights live in the file
+    model = torch.jit.load(path, map_location="cpu")
+    model.eval()
+    return model
+
+
+def build_backend(mode, model, calibration_batch=None, artifact_path=None):
+    """Return a logits callable for `mode` built from the fp32 `model`."""
+    if mode == "fp32":
+        return model
+    if mode == "dynamic_int8":
+        return quantize_dynamic_int8(model)
+    if mode == "static_int8":
+        if calibration_batch is None:
+            raise ValueError("static_int8 needs a calibration batch of real images")
+        return quantize_static_int8(model, calibration_batch)
+    if mode == "bf16":
+        return AutocastModel(copy.deepcopy(model))
+    if mode == "compile":
+        return torch.compile(model)
+    if mode == "torchscript":
+        if artifact_path is None or not os.path.exists(artifact_path):
+            artifact_path = export_torchscript(model, artifact_path or "bmw_model_b4.ts")
+        return load_torchscript(artifact_path)
+    if mode == "onnx":
+        if artifact_path is None or not os.path.exists(artifact_path):
+            artifact_path = export_onnx(model, artifact_path or "bmw_model_b4.onnx")
+        return OnnxModel(artifact_path, num_threads=torch.get_num_threads())
+    raise ValueError(f"Unknown vision backend '{mode}'. Choose from: {', '.join(BACKEND_MODES)}")
+
+
+def load_backend_classifier(mode, model_path, class_json_path, artifact_path=None, calibration_dir=None,
+                            shared_weights=False):
+    """Same return shape as vision.load_classifier, with `mode` applied to the model.
+
+    shared_weights memory-maps the .pth; only fp32 keeps using those pages,
+    the other modes build their own transformed weights.
+    """
+    if mode in ("torchscript", "onnx") and artifact_path and os.path.exists(artifact_path):
+        # Exported graphs load straight from disk, skipping the fp32 .pth entirely
+        classes, idx_to_class = load_class_map(class_json_path)
+        model = load_torchscript(artifact_path) if mode == "torchscript" else OnnxModel(artifact_path)
+        return model, classes, idx_to_class, ClassGroups(idx_to_class)
+
+    model, classes, idx_to_class, groups = load_classifier(model_path, class_json_path, mmap=shared_weights)
+    calibration_batch = None
+    if mode == "static_int8":
+        if not calibration_dir:
+            raise ValueError("static_int8 needs a calibration image folder")
+        calibration_batch, _ = load_image_folder(calibration_dir)
+    backend = build_backend(mode, model, calibration_batch=calibration_batch, artifact_path=artifact_path)
+    return backend, classes, idx_to_class, groups
+
+
+# --- AGREEMENT CHECK ---
+def load_image_folder(folder):
+    from PIL import Image
+
+    tensors, names = [], []
+    for name in sorted(os.listdir(folder)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        try:
+            with Image.open(os.path.join(folder, name)) as img:
+                tensors.append(preprocess(img.convert("RGB")))
+            names.append(name)
+        except OSError:
+            print(f"  skipping unreadable image: {name}")
+    if not tensors:
+        raise FileNotFoundError(f"No images found in {folder}")
+    return torch.stack(tensors), names
+
+
+def run_decisions(backend, images, classes, groups, batch_size):
+    decisions = []
+    start = time.perf_counter()
+    for chunk in images.split(batch_size):
+        decisions.extend(classify_tensors(chunk, backend, classes, groups))
+    elapsed = time.perf_counter() - start
+    return decisions, elapsed * 1000 / len(images)
+
+
+def compare_backends(model, classes, groups, images, modes, batch_size=8, artifact_dir="."):
+    """Top-1 and BMW/non-BMW agreement of each mode against fp32, plus latency."""
+    reference, fp32_ms = run_decisions(model, images, classes, groups, batch_size)
+    report = {"fp32": {"top1_agreement": 1.0, "decision_agreement": 1.0, "ms_per_image": fp32_ms, "safe": True}}
+
+    for mode in modes:
+        if mode == "fp32":
+            continue
+        artifact_path = None
+        if mode in ("torchscript", "onnx"):
+            artifact_path = os.path.join(artifact_dir, f"bmw_model_b4.{'ts' if mode == 'torchscript' else 'onnx'}")
+        try:
+            backend = build_backend(mode, model, calibration_batch=images[:32], artifact_path=artifact_path)
+            # One warm-up batch so compile/JIT time is not counted as latency
+            run_decisions(backend, images[:batch_size], classes, groups, batch_size)
+            decisions, ms = run_decisions(backend, images, classes, groups, batch_size)
+        except Exception as e:
+            report[mode] = {"error": str(e), "safe": False}
+            continue
+
+        top1 = sum(a["chart_data"][0][0] == b["chart_data"][0][0] for a, b in zip(reference, decisions))
+        same_decision = sum(a["is_valid"] == b["is_valid"] for a, b in zip(reference, decisions))
+        report[mode] = {
+            "top1_agreement": top1 / len(reference),
+            "decision_agreement": same_decision / len(reference),
+            "ms_per_image": ms,
+            # Only switch backends when nothing the user sees would change
+            "safe": top1 == len(reference) and same_decision == len(reference),
+        }
+    return report
+
+
+def print_report(report):
+    print(f"{'mode':<14}{'top1':>8}{'decision':>10}{'ms/img':>10}  safe")
+    for mode, row in report.items():
+        if "error" in row:
+            print(f"{mode:<14}  error: {row['error']}")
+            continue
+        print(f"{mode:<14}{row['top1_agreement']:>8.1%}{row['decision_agreement']:>10.1%}"
+              f"{row['ms_per_image']:>10.1f}  {'yes' if row['safe'] else 'NO'}")
+
+
+def main():
+    current_folder = os.path.dirname(os.path.abspath(__file__))
+    models_folder = os.path.join(os.path.dirname(current_folder), "models")
+
+    parser = argparse.ArgumentParser(description="Compare CPU inference backends against fp32.")
+    parser.add_argument("--images", required=True, help="Held-out image folder")
+    parser.add_argument("--modes", default=",".join(BACKEND_MODES))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--model", default=os.path.join(models_folder, "bmw_model_b4_noncar.pth"))
+    parser.add_argument("--classes", default=os.path.join(models_folder, "bmw_class_map_b4.json"))
+    parser.add_argument("--artifact-dir", default=models_folder, help="Where TorchScript/ONNX exports are written")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    model, classes, _, groups = load_classifier(args.model, args.classes)
+    images, names = load_image_folder(args.images)
+    print(f"Loaded {len(names)} held-out images")
+
+    report = compare_backends(
+        model, classes, groups, images, args.modes.split(","),
+        batch_size=args.batch_size, artifact_dir=args.artifact_dir
+    )
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# --- BACKGROUND WARM-UP ---
+# Loads the heavy parts of the app (vision model, embeddings + Chroma) in
+# daemon threads so the Streamlit page renders immediately on a cold start.
+# Each component is a named task whose state the UI can show; callers that
+# actually need a component block on result() until it is ready.
+import threading
+import time
+from concurrent.futures import Future
+
+LOADING = "loading"
+READY = "ready"
+FAILED = "failed"
+
+
+class BackgroundLoader:
+    def __init__(self, background=True):
+        # background=False runs every task inline (old synchronous startup)
+        self.background = background
+        self._futures = {}
+        self._started = {}
+        self._seconds = {}
+        self._lock = threading.Lock()
+
+    def start(self, name, fn):
+        future = Future()
+        with self._lock:
+            self._futures[name] = future
+            self._started[name] = time.perf_counter()
+
+        def run():
+            try:
+                result, error = fn(), None
+            except BaseException as e:
+                result, error = None, e
+            self._seconds[name] = time.perf_counter() - self._started[name]
+            print(f"🔥 {name} {'failed' if error else 'ready'} in {self._seconds[name]:.1f}s")
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        if self.background:
+            threading.Thread(target=run, name=f"warmup-{name}", daemon=True).start()
+        else:
+            run()
+        return future
+
+    def state(self, name):
+        future = self._futures[name]
+        if not future.done():
+            return LOADING
+        return FAILED if future.exception() is not None else READY
+
+    def status(self):
+        """{name: (state, seconds so far or load time, exception or None)}"""
+        now = time.perf_counter()
+        report = {}
+        for name, future in list(self._futures.items()):
+            state = self.state(name)
+            seconds = self._seconds.get(name, now - self._started[name])
+            report[name] = (state, seconds, future.exception() if state == FAILED else None)
+        return report
+
+    def all_done(self):
+        return all(f.done() for f in self._futures.values())
+
+    def result(self, name, timeout=None):
+        """Block until `name` is loaded; re-raises the loader's exception."""
+        return self._futures[name].result(timeout)
@@ -0,0 +1,78 @@
+# --- MULTI-WORKER CPU LAYOUT ---
+# Several service workers on one host (uvicorn service:app --workers N with
+# BMW_WORKERS=N) without N copies of the weights or N x cores threads:
+#
+#   shared weights   each process memory-maps the same checkpoint file
+#                    (torch.load(mmap=True) + load_state_dict(assign=True)),
+#                    so the weights sit once in the page cache and every
+#                    worker's tensors point at those shared, read-only pages
+#   pinning          each worker claims a slot 0..N-1 (an flock'd file, released
+#                    when the process exits), is restricted to its share of the
+#                    cores and runs that many torch threads
+#
+# Pre-forking a loaded master was ruled out: the batching threads and torch's
+# OpenMP pool do not survive fork(), and mmap gives the same sharing.
+import os
+
+_held_slots = []
+
+
+def load_state_dict_mmap(module, path):
+    """Point `module`'s parameters at a memory-mapped checkpoint instead of private copies."""
+    import torch
+
+    state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    module.load_state_dict(state_dict, assign=True)
+    return module
+
+
+def share_module_weights(module, cache_path):
+    """Swap an already-loaded module's weights for an mmap'd copy written once per host."""
+    import torch
+
+    if not os.path.exists(cache_path):
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        torch.save(module.state_dict(), tmp)
+        os.replace(tmp, cache_path)
+    return load_state_dict_mmap(module, cache_path)
+
+
+def claim_worker_slot(lock_dir, workers):
+    """Lowest free slot in 0..workers-1 for this process, or None if all are taken."""
+    import fcntl  # POSIX only; pinning is a Linux deployment feature
+
+    os.makedirs(lock_dir, exist_ok=True)
+    for slot in range(workers):
+        handle = open(os.path.join(lock_dir, f"slot-{slot}.lock"), "w")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        # Held (never closed) for the life of the process
+        _held_slots.append(handle)
+        return slot
+    return None
+
+
+def slot_cores(slot, workers, available=None):
+    """This slot's contiguous share of the cores this process may run on."""
+    available = sorted(available if available is not None else os.sched_getaffinity(0))
+    per_worker = max(1, len(available) // workers)
+    start = (slot * per_worker) % len(available)
+    return available[start:start + per_worker]
+
+
+def configure_worker(workers, lock_dir):
+    """Pin this process to its slot's cores; returns (slot, threads), or (None, 0) when not pinned."""
+    if workers <= 1 or not hasattr(os, "sched_setaffinity"):
+        return None, 0
+    slot = claim_worker_slot(lock_dir, workers)
+    if slot is None:
+        print(f"⚠️ More than BMW_WORKERS={workers} workers running; this one is not pinned")
+        return None, 0
+    cores = slot_cores(slot, workers)
+    os.sched_setaffinity(0, cores)
+    print(f"📌 Worker slot {slot}/{workers}: cores {cores[0]}-{cores[-1]}, {len(cores)} threads")
+    return slot, len(cores)
@@ -0,0 +1,144 @@
+import os
+
+import pytest
+
+from class_metadata import ClassTable, extract_chassis_code
+
+CLASS_MAP = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models", "bmw_class_map_b4.json")
+
+
+# --- The per-call helpers the UI used before the table (bmw.py / pipeline.py) ---
+LEGACY_SUPPORTED_MODELS = [
+    "E30", "E36", "E46",
+    "E28", "E34", "E39",
+    "E24",
+    "E23", "E32", "E38",
+    "E31",
+    "Z3", "Z8",
+    "E53"
+]
+
+
+def legacy_format_class_name(raw_name):
+    if raw_name == "non_bmw_cars":
+        return "Non-BMW Car"
+    if raw_name == "non_cars":
+        return "Not a Vehicle"
+    return raw_name.replace("_", " ")
+
+
+def legacy_extract_chassis_code(raw_name):
+    known_codes = [
+        "E24", "E28", "E30", "E31", "E32", "E34",
+        "E36", "E38", "E39", "E46", "E52", "E53", "E83",
+        "Z1", "Z3", "Z8", "X5"
+    ]
+    raw_name = raw_name.upper()
+    for code in known_codes:
+        if code in raw_name:
+            return code
+    return None
+
+
+def legacy_is_bmw(raw_name):
+    return "non" not in raw_name.lower()
+
+
+def legacy_is_supported(raw_name):
+    return any(code in raw_name for code in LEGACY_SUPPORTED_MODELS)
+
+
+# The one intended change: the Z3s get their own ingest tags instead of the E36 saloon's
+CHASSIS_CHANGES = {
+    "BMW_Z3_Roadster_(E36-7)": ("E36", "E36-7"),
+    "BMW_Z3_Coupe_(E36-8)": ("E36", "E36-8"),
+}
+
+
+@pytest.fixture(scope="module")
+def table():
+    return ClassTable.from_class_map(CLASS_MAP)
+
+
+def test_table_covers_class_map(table):
+    assert len(table) == 151
+    assert [info.index for info in table.entries] == list(range(len(table)))
+
+
+def test_display_names_match(table):
+    for info in table.entries:
+        assert info.display_name == legacy_format_class_name(info.name), info.name
+
+
+def test_groups_match(table):
+    for info in table.entries:
+        assert info.is_bmw == legacy_is_bmw(info.name), info.name
+
+
+def test_supported_flags_match(table):
+    for info in table.entries:
+        assert info.supported == (legacy_is_bmw(info.name) and legacy_is_supported(info.name)), info.name
+
+
+def test_override_options_match(table):
+    legacy_options = sorted(set(legacy_format_class_name(info.name) for info in table.entries if legacy_is_bmw(info.name)))
+    assert table.override_options() == legacy_options
+
+
+def test_chassis_codes_match_except_z3(table):
+    for info in table.entries:
+        if not info.is_bmw:
+            assert info.chassis_code is None, info.name
+            continue
+        expected = CHASSIS_CHANGES[info.name][1] if info.name in CHASSIS_CHANGES else legacy_extract_chassis_code(info.name)
+        assert info.chassis_code == expected, info.name
+
+
+def test_z3_resolves_to_its_own_chassis(table):
+    for name, (old, new) in CHASSIS_CHANGES.items():
+        assert table.lookup(name).index >= 0, name
+        assert legacy_extract_chassis_code(name) == old
+        assert table.lookup(name).chassis_code == new
+        assert table.chassis_for_display(legacy_format_class_name(name)) == new
+
+
+def test_lookup_outside_class_map(table):
+    info = table.lookup("Unknown Non-BMW")
+    assert info.index == -1
+    assert not info.is_bmw and info.chassis_code is None
+
+
+@pytest.mark.parametrize("text, code", [
+    ("BMW_E53_X5", "E53"),
+    ("E36 Convertible", "E36"),
+    ("BMW Z3 (E36-7)", "E36-7"),
+    ("my e46 m3", "E46"),
+    ("a golf", None),
+])
+def test_extract_chassis_code(text, code):
+    assert extract_chassis_code(text) == code
+
+
+def test_by_index(table):
+    assert table.by_index(5) is table[5]
+    info = table.by_index(-1, "Unknown Non-BMW")
+    assert info.index == -1 and info.display_name == "Unknown Non-BMW"
+
+
+def test_decisions_carry_class_index(table):
+    torch = pytest.importorskip("torch")
+    vision = pytest.importorskip("vision")
+    classes, idx_to_class = vision.load_class_map(CLASS_MAP)
+    groups = vision.ClassGroups(idx_to_class)
+    bmw = groups.bmw_indices[3]
+    non_bmw = groups.non_bmw_indices[0]
+    probs = torch.full((2, len(classes)), 0.01 / len(classes))
+    probs[0, bmw] = 0.99
+    probs[1, non_bmw] = 0.99
+
+    first, second = vision.decide_batch(probs, classes, groups, tta_rows={1})
+    assert first["class_index"] == bmw and first["chart_indices"][0] == bmw
+    assert table.by_index(first["class_index"]).name == first["display_name"]
+    assert [table[i].name for i in first["chart_indices"]] == [name for name, _ in first["chart_data"]]
+    assert not second["is_valid"] and second["class_index"] == non_bmw
+    assert first["tta"] is False and second["tta"] is True